@@ -1,27 +1,158 @@
 from math import log, ceil
-from hashlib import md5
-from typing import Generator
+from hashlib import md5, blake2b
+from typing import Generator, Callable, Iterable, Iterator, List, Sequence, Tuple, Union
+
+from experiments.cfrt.thesis.Encoding import encode_positions, decode_positions
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 SHIFT_BYTES_TO_BITS = 3
 MASK_BIT_INDEX = (0x1 << SHIFT_BYTES_TO_BITS) - 1
 
 COUNT_LOOKUP = [format(nibble, "b").count("1") for nibble in range(0, 256)]
 
+# The bits live either in a bytearray or, when numpy is available, in a uint8 array that allows whole array
+# operations. Both pickle to the same bytearray, the storage is a local choice and never goes over the wire.
+STORAGE_BYTEARRAY = "bytearray"
+STORAGE_NUMPY = "numpy"
+DEFAULT_STORAGE = STORAGE_BYTEARRAY
+
+# How the bits are pickled. "dense" always ships the raw bytes, "auto" ships the gap encoded positions of the set
+# bits instead whenever that is smaller, which is the case for the many lightly used filters.
+# Peers that predate the sparse encoding can only read "dense".
+# Mixed versions only interoperate within one wire format: the storage never shows on the wire, but the codec replaced
+# pickle altogether, and pickling peers of older versions need WIRE_DENSE together with the "md5-iterated" family.
+WIRE_DENSE = "dense"
+WIRE_AUTO = "auto"
+WIRE_ENCODING = WIRE_AUTO
+
+# A hash family turns an item into k raw hash values, the filter reduces those modulo its own size. Because the raw
+# values don't depend on the filter size, one set of hashes can be tested against every filter in a chain.
+def md5_iterated_hashes(item: bytes, k: int) -> List[int]:
+    # The original scheme, one md5 digest per index. Kept so filters built by older peers can still be read.
+    hash = md5(item)
+    result = []
+    for i in range(0, k):
+        hash.update(bytes([i]))
+        result.append(int.from_bytes(hash.digest(), "little"))
+    return result
+
+def double_hashes(digest: Callable) -> Callable[[bytes, int], List[int]]:
+    # Kirsch-Mitzenmacher double hashing, derive all k indexes as h1 + i * h2 from a single 128 bit digest
+    def hashes(item: bytes, k: int) -> List[int]:
+        value = digest(item).digest()
+        h1 = int.from_bytes(value[:8], "little")
+        h2 = int.from_bytes(value[8:16], "little") | 0x1
+        return [h1 + i * h2 for i in range(0, k)]
+    return hashes
+
+HASH_FAMILIES = {
+    "md5-iterated": md5_iterated_hashes,
+    "md5": double_hashes(md5),
+    "blake2b": double_hashes(lambda item: blake2b(item, digest_size=16)),
+}
+
+# Filters of different families can't be combined, a filter only keeps its bits so there is nothing to hash again.
+# Peers that predate hash families only use "md5-iterated", set this to that to keep combining with them.
+DEFAULT_HASH_FAMILY = "md5"
+
+def register_hash_family(name: str, hashes: Callable[[bytes, int], List[int]]) -> None:
+    HASH_FAMILIES[name] = hashes
+
+# items are strings or 128 bit integer tags, the bytes that get hashed have to be the same on every replica
+def item_bytes(item: Union[str, int]) -> bytes:
+    if isinstance(item, int):
+        return item.to_bytes(16, "little")
+    return item.encode()
+
 class BloomFilter:
     FALSE_POSITIVE_PROBABILITY = 0.00000001
     EXPECTED_ELEMENTS = 2000
 
-    def __init__(self, max_elements=EXPECTED_ELEMENTS) -> None:
-        self.k = int(ceil(-log(BloomFilter.FALSE_POSITIVE_PROBABILITY) / log(2)))
-        self.m = int(ceil(-max_elements * log(BloomFilter.FALSE_POSITIVE_PROBABILITY) / (log(2) ** 2)))
+    # filters pickled before hash families existed don't carry the attribute, those used the iterated scheme
+    hash_family = "md5-iterated"
+
+    def __init__(self, max_elements=EXPECTED_ELEMENTS, hash_family=DEFAULT_HASH_FAMILY, storage=None) -> None:
+        self.k, self.m = BloomFilter.shape(max_elements)
         self.max_elements = max_elements
         self.estimated_size = 0
+        self.hash_family = hash_family
+
+        self.use_storage(DEFAULT_STORAGE if storage is None else storage, bytearray(1 + (self.m >> SHIFT_BYTES_TO_BITS)))
+
+    # the number of hashes and bits of a filter for max_elements elements
+    @staticmethod
+    def shape(max_elements: int) -> Tuple[int, int]:
+        k = int(ceil(-log(BloomFilter.FALSE_POSITIVE_PROBABILITY) / log(2)))
+        m = int(ceil(-max_elements * log(BloomFilter.FALSE_POSITIVE_PROBABILITY) / (log(2) ** 2)))
+        return k, m
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["storage"]
+        del state["bits"]
+        sparse = self.encode_sparse() if WIRE_ENCODING == WIRE_AUTO else None
+        if sparse is None:
+            state["bits"] = bytearray(self.bits)
+        else:
+            state["sparse_bits"] = sparse
+        return state
 
-        self.bits = bytearray(1 + (self.m >> SHIFT_BYTES_TO_BITS))
+    def __setstate__(self, state):
+        if "sparse_bits" in state:
+            bits = self.decode_sparse(state.pop("sparse_bits"), 1 + (state["m"] >> SHIFT_BYTES_TO_BITS))
+        else:
+            bits = state.pop("bits")
+        self.__dict__.update(state)
+        self.use_storage(DEFAULT_STORAGE, bits)
+
+    # returns the sparse encoding of the bits, or None when it wouldn't be smaller than the raw bytes
+    def encode_sparse(self) -> Union[bytes, None]:
+        # every position takes at least a byte, don't bother encoding filters that are already too full for that
+        if self.count_ones() >= len(self.bits):
+            return None
+        sparse = encode_positions(self.set_positions())
+        if len(sparse) >= len(self.bits):
+            return None
+        return sparse
+
+    @staticmethod
+    def decode_sparse(sparse: bytes, length: int) -> bytearray:
+        bits = bytearray(length)
+        for index in decode_positions(sparse):
+            if index >= length << SHIFT_BYTES_TO_BITS:
+                raise ValueError("Sparse bloom filter position %s out of range" % index)
+            bits[index >> SHIFT_BYTES_TO_BITS] |= 0x1 << (index & MASK_BIT_INDEX)
+        return bits
+
+    def set_positions(self) -> Iterator[int]:
+        if self.storage == STORAGE_NUMPY:
+            return iter(numpy.flatnonzero(numpy.unpackbits(self.bits, bitorder="little")).tolist())
+        return (byte_index << SHIFT_BYTES_TO_BITS | shift
+                for byte_index, byte in enumerate(self.bits) if byte
+                for shift in range(0, 1 << SHIFT_BYTES_TO_BITS) if (byte >> shift) & 0x1)
+
+    def use_storage(self, storage: str, bits) -> None:
+        if storage == STORAGE_NUMPY:
+            if numpy is None:
+                raise ImportError("BloomFilter numpy storage requested, but numpy is not installed")
+            self.bits = numpy.frombuffer(bytes(bits), dtype=numpy.uint8).copy()
+        elif storage == STORAGE_BYTEARRAY:
+            self.bits = bytearray(bits)
+        else:
+            raise ValueError("Unknown BloomFilter storage %r" % storage)
+        self.storage = storage
+
+    def count_ones(self) -> int:
+        if self.storage == STORAGE_NUMPY:
+            return int(numpy.count_nonzero(numpy.unpackbits(self.bits)))
+        return bin(int.from_bytes(self.bits, "little")).count("1")
 
     def estimate_size(self):
-        ones = sum(COUNT_LOOKUP[x] for x in self.bits)
-        return -(self.m/self.k)*log(1-ones/self.m)
+        return -(self.m/self.k)*log(1-self.count_ones()/self.m)
 
     def get_bit(self, index: int) -> int:
         return (self.bits[ index >> SHIFT_BYTES_TO_BITS ] >> (index & MASK_BIT_INDEX)) & 0x1
@@ -29,28 +160,96 @@ class BloomFilter:
     def set_bit(self, index: int, value: int) -> None:
         byte = index >> SHIFT_BYTES_TO_BITS
         shift = index & MASK_BIT_INDEX
-        self.bits[byte] = (self.bits[byte] & ~(0x1 << shift)) | (value << (index & MASK_BIT_INDEX))
+        if value:
+            self.bits[byte] |= 0x1 << shift
+        else:
+            self.bits[byte] &= 0xFF ^ (0x1 << shift)
+
+    def lookup(self, item: Union[str, int]) -> bool:
+        return self.lookup_hashes(self.hashes_for(item))
+
+    def add(self, item: Union[str, int]) -> None:
+        self.add_hashes(self.hashes_for(item))
 
-    def lookup(self, item: str) -> bool:
-        for index in self.indexes_for(item):
-            if self.get_bit(index) == 0:
+    def lookup_many(self, items: Iterable[Union[str, int]]) -> List[bool]:
+        return self.lookup_hashes_many([self.hashes_for(item) for item in items])
+
+    def add_many(self, items: Iterable[Union[str, int]]) -> None:
+        self.add_hashes_many([self.hashes_for(item) for item in items])
+
+    # the *_hashes variants take the output of hashes_for, so callers can reuse it over filters of the same family
+    def lookup_hashes_many(self, hashes: Sequence[Sequence[int]]) -> List[bool]:
+        if self.storage == STORAGE_NUMPY:
+            if len(hashes) == 0:
+                return []
+            indexes = self._index_array(hashes)
+            found = (self.bits[indexes >> SHIFT_BYTES_TO_BITS] >> (indexes & MASK_BIT_INDEX)) & 0x1
+            return found.all(axis=1).tolist()
+        return [self.lookup_hashes(item) for item in hashes]
+
+    def add_hashes_many(self, hashes: Sequence[Sequence[int]]) -> None:
+        if self.storage == STORAGE_NUMPY:
+            if len(hashes) == 0:
+                return
+            self.estimated_size += len(hashes)
+            indexes = self._index_array(hashes).ravel()
+            numpy.bitwise_or.at(self.bits, indexes >> SHIFT_BYTES_TO_BITS, numpy.left_shift(1, indexes & MASK_BIT_INDEX).astype(numpy.uint8))
+            return
+        for item in hashes:
+            self.add_hashes(item)
+
+    def _index_array(self, hashes: Sequence[Sequence[int]]):
+        return numpy.array([[hash % self.m for hash in item] for item in hashes], dtype=numpy.int64)
+
+    def lookup_hashes(self, hashes: Sequence[int]) -> bool:
+        if self.storage == STORAGE_NUMPY:
+            return self.lookup_hashes_many([hashes])[0]
+        bits = self.bits
+        for hash in hashes:
+            index = hash % self.m
+            if not (bits[index >> SHIFT_BYTES_TO_BITS] >> (index & MASK_BIT_INDEX)) & 0x1:
                 return False
         return True
 
-    def add(self, item: str) -> None:
+    def add_hashes(self, hashes: Sequence[int]) -> None:
+        if self.storage == STORAGE_NUMPY:
+            self.add_hashes_many([hashes])
+            return
         self.estimated_size += 1
-        for index in self.indexes_for(item):
-            self.set_bit(index, 1)
+        bits = self.bits
+        for hash in hashes:
+            index = hash % self.m
+            bits[index >> SHIFT_BYTES_TO_BITS] |= 0x1 << (index & MASK_BIT_INDEX)
+
+    # returns the index of a bit that is not set, proving the item is not in the filter, or None if all are set
+    def first_unset(self, hashes: Sequence[int]) -> Union[int, None]:
+        for hash in hashes:
+            index = hash % self.m
+            if not self.get_bit(index):
+                return index
+        return None
 
-    def combine(self, other: "BloomFilter") -> None:
-        for n in range(0, len(self.bits)):
-            self.bits[n] |= other.bits[n]
+    # ORs the other filter into this one, returns whether any bit changed
+    def combine(self, other: "BloomFilter") -> bool:
+        if other.m != self.m or other.hash_family != self.hash_family:
+            raise ValueError("Can't combine bloom filters of different shape (%s, %s) != (%s, %s)" % (self.m, self.hash_family, other.m, other.hash_family))
+        if self.storage == STORAGE_NUMPY:
+            theirs = numpy.frombuffer(other.bits, dtype=numpy.uint8)
+            changed = bool(numpy.any(theirs & ~self.bits))
+            numpy.bitwise_or(self.bits, theirs, out=self.bits)
+        else:
+            mine = int.from_bytes(self.bits, "little")
+            merged = mine | int.from_bytes(other.bits, "little")
+            changed = merged != mine
+            self.bits = bytearray(merged.to_bytes(len(self.bits), "little"))
         self.estimated_size = self.estimate_size()
         if self.estimated_size > self.max_elements:
             print("Bloom filter overflow %s > %s" % (self.estimated_size, self.max_elements))
+        return changed
+
+    def hashes_for(self, item: Union[str, int]) -> List[int]:
+        return HASH_FAMILIES[self.hash_family](item_bytes(item), self.k)
 
-    def indexes_for(self, item: str) -> Generator[int, None, None]:
-        hash = md5(item.encode())
-        for i in range(0, self.k):
-            hash.update(bytes([i]))
-            yield int.from_bytes(hash.digest(), "little") % self.m
+    def indexes_for(self, item: Union[str, int]) -> Generator[int, None, None]:
+        for hash in self.hashes_for(item):
+            yield hash % self.m
@@ -0,0 +1,551 @@
+import sys
+from array import array
+from struct import Struct, error as StructError
+
+from experiments.cfrt.thesis.BloomFilter import BloomFilter, HASH_FAMILIES, SHIFT_BYTES_TO_BITS, WIRE_AUTO
+from experiments.cfrt.thesis.CrdtRTree import CrdtRTreeEntry
+from experiments.cfrt.thesis.CrdtSet import CrdtSet, CrdtDelta, CrdtReconciliation
+from experiments.cfrt.thesis.Encoding import encode_varint, decode_varint
+from experiments.cfrt.thesis.InvertibleBloomFilter import InvertibleBloomFilter
+from experiments.cfrt.thesis.NaiveORSet import NaiveORSet
+from experiments.cfrt.thesis.OptOrSet import OptORSet
+from experiments.cfrt.thesis.TombstoneStore import ExactTagStore, BloomChainStore, CuckooChainStore, CuckooFilter, CUCKOO_BUCKET_SIZE, TOMBSTONE_STORES
+import experiments.cfrt.thesis.BloomFilter as BloomFilterModule
+
+# Binary encoding of the replica states that go over the wire, replacing pickle. Every buffer starts with
+#   MAGIC, CODEC_VERSION, object type
+# followed by the object. Integers are varints (zigzag for the ones that can be negative), strings and byte arrays are
+# length prefixed, tags are their 16 raw bytes and bloomfilters keep their bit arrays as is.
+# Decoded strings are interned, so the many replicas that hold the same element or key share one string object.
+# Decoding only ever builds the known types, anything that doesn't parse raises CodecError.
+MAGIC = 0xCF
+CODEC_VERSION = 3
+
+TYPE_CRDT_SET = 1
+TYPE_OPTOR_SET = 2
+TYPE_NAIVE_OR_SET = 3
+TYPE_CRDT_DELTA = 4
+TYPE_RECONCILIATION = 5
+TYPE_IBLT = 6
+TYPE_RTREE_ENTRY = 7
+
+# element values
+VALUE_NONE = 0
+VALUE_STR = 1
+VALUE_INT = 2
+VALUE_TUPLE = 3
+VALUE_RTREE_ENTRY = 4
+
+STORE_EXACT = 0
+STORE_BLOOM = 1
+STORE_CUCKOO = 2
+
+BITS_RAW = 0
+BITS_SPARSE = 1
+
+TAG_SIZE = 16
+MAX_NESTING = 8
+# Upper bounds on sizes the decoder will allocate. Bloom filters are checked against MAX_DECODE_BYTES as a whole, as
+# their sparse encoding is only a few bytes for a large filter with few bits set. A filter for MAX_BLOOM_ELEMENTS
+# tags takes 20MB.
+MAX_BLOOM_ELEMENTS = 2 ** 22
+MAX_DECODE_BYTES = 2 ** 25
+MAX_CUCKOO_BUCKETS = 2 ** 24
+
+DOUBLE = Struct("<d")
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Encoder:
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def byte(self, value: int) -> None:
+        self.buffer.append(value)
+
+    def varint(self, value: int) -> None:
+        encode_varint(value, self.buffer)
+
+    def signed(self, value: int) -> None:
+        encode_varint(value << 1 if value >= 0 else ((-value) << 1) - 1, self.buffer)
+
+    def double(self, value: float) -> None:
+        self.buffer.extend(DOUBLE.pack(value))
+
+    def raw(self, value: bytes) -> None:
+        self.buffer.extend(value)
+
+    def bytes(self, value: bytes) -> None:
+        self.varint(len(value))
+        self.buffer.extend(value)
+
+    def string(self, value: str) -> None:
+        self.bytes(value.encode())
+
+    def tag(self, value: int) -> None:
+        try:
+            self.buffer.extend(value.to_bytes(TAG_SIZE, "little"))
+        except (OverflowError, AttributeError):
+            raise CodecError("Tag %r is not a %s byte integer" % (value, TAG_SIZE))
+
+    def value(self, value, depth=0) -> None:
+        if depth > MAX_NESTING:
+            raise CodecError("Element nested too deep")
+        if value is None:
+            self.byte(VALUE_NONE)
+        elif isinstance(value, str):
+            self.byte(VALUE_STR)
+            self.string(value)
+        elif isinstance(value, int) and not isinstance(value, bool):
+            self.byte(VALUE_INT)
+            self.signed(value)
+        elif isinstance(value, tuple):
+            self.byte(VALUE_TUPLE)
+            self.varint(len(value))
+            for item in value:
+                self.value(item, depth + 1)
+        elif isinstance(value, CrdtRTreeEntry):
+            self.byte(VALUE_RTREE_ENTRY)
+            self.rtree_entry(value, depth)
+        else:
+            raise CodecError("Can't encode element of type %s" % type(value).__name__)
+
+    def rtree_entry(self, entry: CrdtRTreeEntry, depth=0) -> None:
+        self.value(entry.key_min, depth + 1)
+        self.value(entry.key_max, depth + 1)
+        self.value(entry.value, depth + 1)
+
+    def entries(self, entries) -> None:
+        self.varint(len(entries))
+        for element, tag in entries:
+            self.value(element)
+            self.tag(tag)
+
+    def tags(self, tags) -> None:
+        self.varint(len(tags))
+        for tag in tags:
+            self.tag(tag)
+
+    def epochs(self, epochs: dict) -> None:
+        self.varint(len(epochs))
+        for replica_id, epoch in epochs.items():
+            self.tag(replica_id)
+            self.signed(epoch)
+
+    def bloomfilter(self, bloom: BloomFilter) -> None:
+        self.varint(bloom.max_elements)
+        self.varint(bloom.k)
+        self.varint(bloom.m)
+        self.string(bloom.hash_family)
+        self.double(bloom.estimated_size)
+        sparse = bloom.encode_sparse() if BloomFilterModule.WIRE_ENCODING == WIRE_AUTO else None
+        if sparse is None:
+            self.byte(BITS_RAW)
+            self.raw(bytes(bloom.bits))
+        else:
+            self.byte(BITS_SPARSE)
+            self.bytes(sparse)
+
+    def store(self, store) -> None:
+        if isinstance(store, ExactTagStore):
+            self.byte(STORE_EXACT)
+            self.varint(0 if store.limit is None else store.limit + 1)
+            self.string(store.promote_to or "")
+            self.string(store.hash_family)
+            self.tags(store.tags)
+        elif isinstance(store, BloomChainStore):
+            self.byte(STORE_BLOOM)
+            self.tag(store.replica_id)
+            self.varint(store.bloom_slack)
+            self.varint(store.base_epoch)
+            self.epochs(store.active_epochs)
+            self.epochs(store.stable_epochs)
+            self.varint(len(store.bloomfilters))
+            for bloom in store.bloomfilters:
+                self.bloomfilter(bloom)
+        elif isinstance(store, CuckooChainStore):
+            self.byte(STORE_CUCKOO)
+            self.varint(store.filters[0].buckets)
+            self.varint(len(store.filters))
+            for cuckoo in store.filters:
+                slots = array("I", cuckoo.slots)
+                if sys.byteorder != "little":
+                    slots.byteswap()
+                self.raw(slots.tobytes())
+        else:
+            raise CodecError("Can't encode tombstone store %s" % type(store).__name__)
+
+
+class Decoder:
+    def __init__(self, buffer) -> None:
+        self.buffer = bytes(buffer)
+        self.offset = 0
+        # bytes allocated for bloom filter bits so far
+        self.allocated = 0
+
+    def remaining(self) -> int:
+        return len(self.buffer) - self.offset
+
+    def take(self, length: int) -> bytes:
+        end = self.offset + length
+        if end > len(self.buffer):
+            raise CodecError("Truncated buffer, need %s bytes but %s are left" % (length, self.remaining()))
+        value = self.buffer[self.offset:end]
+        self.offset = end
+        return value
+
+    def byte(self) -> int:
+        if self.offset >= len(self.buffer):
+            raise CodecError("Truncated buffer")
+        self.offset += 1
+        return self.buffer[self.offset - 1]
+
+    def varint(self) -> int:
+        try:
+            value, self.offset = decode_varint(self.buffer, self.offset)
+        except ValueError as e:
+            raise CodecError(str(e))
+        return value
+
+    def signed(self) -> int:
+        value = self.varint()
+        return value >> 1 if value & 0x1 == 0 else -((value + 1) >> 1)
+
+    # a count of items that take at least minimum bytes each, checked against the buffer before anything is allocated
+    def count(self, minimum=1) -> int:
+        count = self.varint()
+        if count * minimum > self.remaining():
+            raise CodecError("Count %s exceeds the buffer" % count)
+        return count
+
+    def double(self) -> float:
+        return DOUBLE.unpack(self.take(DOUBLE.size))[0]
+
+    def bytes(self) -> bytes:
+        return self.take(self.count())
+
+    def string(self) -> str:
+        try:
+            return sys.intern(self.bytes().decode())
+        except UnicodeDecodeError as e:
+            raise CodecError(str(e))
+
+    def tag(self) -> int:
+        return int.from_bytes(self.take(TAG_SIZE), "little")
+
+    def value(self, depth=0):
+        if depth > MAX_NESTING:
+            raise CodecError("Element nested too deep")
+        kind = self.byte()
+        if kind == VALUE_NONE:
+            return None
+        if kind == VALUE_STR:
+            return self.string()
+        if kind == VALUE_INT:
+            return self.signed()
+        if kind == VALUE_TUPLE:
+            return tuple(self.value(depth + 1) for _ in range(0, self.count()))
+        if kind == VALUE_RTREE_ENTRY:
+            return self.rtree_entry(depth)
+        raise CodecError("Unknown element type %s" % kind)
+
+    def rtree_entry(self, depth=0) -> CrdtRTreeEntry:
+        key_min = self.value(depth + 1)
+        key_max = self.value(depth + 1)
+        return CrdtRTreeEntry((key_min, key_max), self.value(depth + 1))
+
+    # the bulk of every state, short string elements are decoded inline
+    def entries(self) -> set:
+        result = set()
+        buffer = self.buffer
+        for _ in range(0, self.count(1 + TAG_SIZE)):
+            offset = self.offset
+            if offset + 2 < len(buffer) and buffer[offset] == VALUE_STR and buffer[offset + 1] < 0x80:
+                end = offset + 2 + buffer[offset + 1]
+                if end + TAG_SIZE > len(buffer):
+                    raise CodecError("Truncated buffer")
+                try:
+                    element = sys.intern(buffer[offset + 2:end].decode())
+                except UnicodeDecodeError as e:
+                    raise CodecError(str(e))
+                result.add((element, int.from_bytes(buffer[end:end + TAG_SIZE], "little")))
+                self.offset = end + TAG_SIZE
+            else:
+                result.add((self.value(), self.tag()))
+        return result
+
+    def tags(self) -> set:
+        return {self.tag() for _ in range(0, self.count(TAG_SIZE))}
+
+    def epochs(self) -> dict:
+        return {self.tag(): self.signed() for _ in range(0, self.count(TAG_SIZE + 1))}
+
+    def hash_family(self) -> str:
+        family = self.string()
+        if not family in HASH_FAMILIES:
+            raise CodecError("Unknown hash family %r" % family)
+        return family
+
+    # the shape of a filter follows from max_elements, one that doesn't match it could never be combined with ours
+    def bloomfilter(self) -> BloomFilter:
+        max_elements = self.varint()
+        k = self.varint()
+        m = self.varint()
+        if max_elements == 0 or max_elements > MAX_BLOOM_ELEMENTS:
+            raise CodecError("Bloom filter size %s out of range" % max_elements)
+        if (k, m) != BloomFilter.shape(max_elements):
+            raise CodecError("Bloom filter shape (%s, %s) doesn't match its size %s" % (k, m, max_elements))
+        hash_family = self.hash_family()
+        estimated_size = self.double()
+        length = 1 + (m >> SHIFT_BYTES_TO_BITS)
+        self.allocated += length
+        if self.allocated > MAX_DECODE_BYTES:
+            raise CodecError("Bloom filters take more than %s bytes" % MAX_DECODE_BYTES)
+        encoding = self.byte()
+        if encoding == BITS_RAW:
+            bits = bytearray(self.take(length))
+        elif encoding == BITS_SPARSE:
+            bits = BloomFilter.decode_sparse(self.bytes(), length)
+        else:
+            raise CodecError("Unknown bloom filter bit encoding %s" % encoding)
+        bloom = BloomFilter.__new__(BloomFilter)
+        bloom.__setstate__({"k": k, "m": m, "max_elements": max_elements, "estimated_size": estimated_size, "hash_family": hash_family, "bits": bits})
+        return bloom
+
+    def store(self):
+        kind = self.byte()
+        if kind == STORE_EXACT:
+            limit = self.varint()
+            promote_to = self.string()
+            if promote_to and not promote_to in TOMBSTONE_STORES:
+                raise CodecError("Unknown tombstone store %r" % promote_to)
+            store = ExactTagStore(None if limit == 0 else limit - 1, promote_to or None, self.hash_family())
+            store.tags = self.tags()
+            return store
+        if kind == STORE_BLOOM:
+            store = BloomChainStore.__new__(BloomChainStore)
+            store.replica_id = self.tag()
+            store.bloom_slack = self.varint()
+            store.base_epoch = self.varint()
+            store.active_epochs = self.epochs()
+            store.stable_epochs = self.epochs()
+            store.bloomfilters = [self.bloomfilter() for _ in range(0, self.count())]
+            if len(store.bloomfilters) == 0:
+                raise CodecError("Bloom filter chain without filters")
+            # every filter in a chain is twice the size of the one before it
+            for previous, bloom in zip(store.bloomfilters, store.bloomfilters[1:]):
+                if bloom.max_elements != previous.max_elements * 2 or bloom.hash_family != previous.hash_family:
+                    raise CodecError("Bloom filter chain of mismatching filters")
+            return store
+        if kind == STORE_CUCKOO:
+            buckets = self.varint()
+            if buckets == 0 or buckets > MAX_CUCKOO_BUCKETS or buckets & (buckets - 1) != 0:
+                raise CodecError("Cuckoo filter bucket count %s is not a power of two in range" % buckets)
+            length = buckets * CUCKOO_BUCKET_SIZE * 4
+            store = CuckooChainStore()
+            store.filters = []
+            for _ in range(0, self.count(length)):
+                cuckoo = CuckooFilter(buckets)
+                slots = array("I")
+                slots.frombytes(self.take(length))
+                if sys.byteorder != "little":
+                    slots.byteswap()
+                cuckoo.slots = slots
+                store.filters.append(cuckoo)
+            if len(store.filters) == 0:
+                raise CodecError("Cuckoo filter chain without filters")
+            return store
+        raise CodecError("Unknown tombstone store %s" % kind)
+
+
+def encode_crdt_set(encoder: Encoder, replica: CrdtSet) -> None:
+    encoder.tag(replica.replica_id)
+    encoder.varint(replica.delta_seq)
+    encoder.entries(replica.entries)
+    encoder.store(replica.tombstones)
+
+def decode_crdt_set(decoder: Decoder) -> CrdtSet:
+    replica = CrdtSet.__new__(CrdtSet)
+    replica.__setstate__({"replica_id": decoder.tag(), "delta_seq": decoder.varint(), "entries": decoder.entries(),
+                          "tombstones": decoder.store(), "Dirty": True})
+    return replica
+
+# the ids are long and shared by many entries, they are written once and referenced by index
+def encode_optor_set(encoder: Encoder, replica: OptORSet) -> None:
+    ids = {replica.Id: 0}
+    for replica_id in replica.Vector.keys():
+        ids.setdefault(replica_id, len(ids))
+    for replica_id in replica.Retired.keys():
+        ids.setdefault(replica_id, len(ids))
+    for entry in replica.Entries:
+        ids.setdefault(entry[1], len(ids))
+    encoder.varint(len(ids))
+    for replica_id in ids.keys():
+        encoder.string(replica_id)
+    encoder.varint(replica.Clock)
+    encoder.varint(len(replica.Vector))
+    for replica_id, intervals in replica.Vector.items():
+        encoder.varint(ids[replica_id])
+        encoder.varint(len(intervals))
+        previous = 0
+        for l, r in intervals:
+            encoder.varint(l - previous)
+            encoder.varint(r - l)
+            previous = r
+    encoder.varint(len(replica.Retired))
+    for replica_id, clock in replica.Retired.items():
+        encoder.varint(ids[replica_id])
+        encoder.varint(clock)
+    encoder.varint(len(replica.Entries))
+    for item, replica_id, clock in replica.Entries:
+        encoder.value(item)
+        encoder.varint(ids[replica_id])
+        encoder.varint(clock)
+
+def decode_optor_set(decoder: Decoder) -> OptORSet:
+    ids = [decoder.string() for _ in range(0, decoder.count())]
+    if len(ids) == 0:
+        raise CodecError("OptORSet without id")
+
+    def replica_id():
+        index = decoder.varint()
+        if index >= len(ids):
+            raise CodecError("OptORSet id index %s out of range" % index)
+        return ids[index]
+
+    clock = decoder.varint()
+    vector = dict()
+    for _ in range(0, decoder.count(2)):
+        vector_id = replica_id()
+        intervals = []
+        previous = 0
+        for _ in range(0, decoder.count(2)):
+            l = previous + decoder.varint()
+            previous = l + decoder.varint()
+            intervals.append((l, previous))
+        vector[vector_id] = intervals
+    retired = {replica_id(): decoder.varint() for _ in range(0, decoder.count(2))}
+    entries = {(decoder.value(), replica_id(), decoder.varint()) for _ in range(0, decoder.count(3))}
+    replica = OptORSet.__new__(OptORSet)
+    replica.__setstate__({"Id": ids[0], "Clock": clock, "Dirty": True, "Vector": vector, "Retired": retired, "Entries": entries})
+    return replica
+
+# tombstones are nearly always inserts as well, those only take a flag
+def encode_naive_or_set(encoder: Encoder, replica: NaiveORSet) -> None:
+    encoder.varint(len(replica.Insert))
+    for entry in replica.Insert:
+        encoder.value(entry[0])
+        encoder.tag(entry[1])
+        encoder.byte(1 if entry in replica.Tombstones else 0)
+    encoder.entries(replica.Tombstones - replica.Insert)
+
+def decode_naive_or_set(decoder: Decoder) -> NaiveORSet:
+    inserts = set()
+    tombstones = set()
+    for _ in range(0, decoder.count(2 + TAG_SIZE)):
+        entry = (decoder.value(), decoder.tag())
+        inserts.add(entry)
+        if decoder.byte():
+            tombstones.add(entry)
+    tombstones |= decoder.entries()
+    replica = NaiveORSet.__new__(NaiveORSet)
+    replica.__setstate__({"Insert": inserts, "Tombstones": tombstones, "Dirty": True})
+    return replica
+
+def encode_delta(encoder: Encoder, delta: CrdtDelta) -> None:
+    if delta.origin is None:
+        encoder.byte(0)
+    else:
+        encoder.byte(1)
+        encoder.tag(delta.origin)
+    encoder.varint(delta.seq)
+    encoder.entries(delta.entries)
+    encoder.entries(delta.removals)
+
+def decode_delta(decoder: Decoder) -> CrdtDelta:
+    origin = decoder.tag() if decoder.byte() else None
+    return CrdtDelta(origin, decoder.varint(), decoder.entries(), decoder.entries())
+
+def encode_reconciliation(encoder: Encoder, reconciliation: CrdtReconciliation) -> None:
+    encoder.entries(reconciliation.entries)
+    encoder.tags(reconciliation.removed)
+    encoder.tags(reconciliation.wanted)
+
+def decode_reconciliation(decoder: Decoder) -> CrdtReconciliation:
+    return CrdtReconciliation(decoder.entries(), decoder.tags(), decoder.tags())
+
+def encode_iblt(encoder: Encoder, table: InvertibleBloomFilter) -> None:
+    encoder.varint(table.cells)
+    encoder.varint(table.hashes)
+    encoder.signed(table.size)
+    for count, key_sum, hash_sum in zip(table.counts, table.key_sums, table.hash_sums):
+        encoder.signed(count)
+        encoder.raw(key_sum.to_bytes(TAG_SIZE, "little"))
+        encoder.raw(hash_sum.to_bytes(8, "little"))
+
+def decode_iblt(decoder: Decoder) -> InvertibleBloomFilter:
+    cells = decoder.varint()
+    hashes = decoder.varint()
+    if hashes == 0 or cells == 0 or cells % hashes != 0 or cells * (1 + TAG_SIZE + 8) > decoder.remaining():
+        raise CodecError("Invertible bloom filter shape (%s, %s) out of range" % (cells, hashes))
+    table = InvertibleBloomFilter(cells, hashes)
+    table.size = decoder.signed()
+    for index in range(0, cells):
+        table.counts[index] = decoder.signed()
+        table.key_sums[index] = int.from_bytes(decoder.take(TAG_SIZE), "little")
+        table.hash_sums[index] = int.from_bytes(decoder.take(8), "little")
+    return table
+
+CODECS = {
+    CrdtSet: (TYPE_CRDT_SET, encode_crdt_set),
+    OptORSet: (TYPE_OPTOR_SET, encode_optor_set),
+    NaiveORSet: (TYPE_NAIVE_OR_SET, encode_naive_or_set),
+    CrdtDelta: (TYPE_CRDT_DELTA, encode_delta),
+    CrdtReconciliation: (TYPE_RECONCILIATION, encode_reconciliation),
+    InvertibleBloomFilter: (TYPE_IBLT, encode_iblt),
+    CrdtRTreeEntry: (TYPE_RTREE_ENTRY, Encoder.rtree_entry),
+}
+
+DECODERS = {
+    TYPE_CRDT_SET: decode_crdt_set,
+    TYPE_OPTOR_SET: decode_optor_set,
+    TYPE_NAIVE_OR_SET: decode_naive_or_set,
+    TYPE_CRDT_DELTA: decode_delta,
+    TYPE_RECONCILIATION: decode_reconciliation,
+    TYPE_IBLT: decode_iblt,
+    TYPE_RTREE_ENTRY: Decoder.rtree_entry,
+}
+
+def dumps(obj) -> bytes:
+    if not type(obj) in CODECS:
+        raise CodecError("Can't encode %s" % type(obj).__name__)
+    object_type, encode = CODECS[type(obj)]
+    encoder = Encoder()
+    encoder.byte(MAGIC)
+    encoder.byte(CODEC_VERSION)
+    encoder.byte(object_type)
+    encode(encoder, obj)
+    return bytes(encoder.buffer)
+
+def loads(buffer):
+    decoder = Decoder(buffer)
+    try:
+        if decoder.byte() != MAGIC:
+            raise CodecError("Not a replica state")
+        version = decoder.byte()
+        if version != CODEC_VERSION:
+            raise CodecError("Unsupported codec version %s" % version)
+        object_type = decoder.byte()
+        if not object_type in DECODERS:
+            raise CodecError("Unknown object type %s" % object_type)
+        obj = DECODERS[object_type](decoder)
+    except (ValueError, OverflowError, StructError, TypeError) as e:
+        if isinstance(e, CodecError):
+            raise
+        raise CodecError(str(e))
+    if decoder.remaining() != 0:
+        raise CodecError("%s trailing bytes" % decoder.remaining())
+    return obj
@@ -1,14 +1,15 @@
-import pickle
 import sys
 
-from asyncio import Future
+from asyncio import Future, shield
 
 from random import randint
 from math import ceil
 from time import perf_counter
-from typing import Tuple
+from typing import Iterable, Tuple
 
-from experiments.cfrt.thesis.CrdtSet import CrdtSet
+import experiments.cfrt.thesis.Codec as Codec
+from experiments.cfrt.thesis.CrdtSet import CrdtSet, CrdtDelta, CrdtReconciliation
+from experiments.cfrt.thesis.InvertibleBloomFilter import InvertibleBloomFilter
 from ipv8.keyvault.crypto import default_eccrypto
 from ipv8.lazy_community import lazy_wrapper
 from ipv8.messaging.lazy_payload import vp_compile, VariablePayload
@@ -28,6 +29,16 @@ FRAGMENT_MAX_SIZE = 63 * 1024
 STATS_DECAY = 0.75
 STATS_DECAY_ALT = 1.0 - STATS_DECAY
 
+# In delta mode a CrdtSet replica only ships the changes since its previous broadcast. Every FULL_STATE_INTERVAL-th
+# broadcast still carries the full state, so peers that joined late or lost a delta catch up without asking.
+FULL_STATE_INTERVAL = 10
+
+# In reconciliation mode a CrdtSet replica broadcasts a digest of its entries instead. A peer decodes the difference
+# and answers with a CrdtReconciliation, which we answer with a delta of the entries it wanted:
+#   digest ->, <- reconciliation, delta ->
+# When the difference is too large to decode both sides exchange their full state. The full state interval still
+# applies, digests only cover entries and the tombstones of entries neither side has travel with the full state.
+
 @vp_compile
 class CrdtStateMessage(VariablePayload):
     msg_id = 1
@@ -52,25 +63,70 @@ class CrdtCommunity(Community):
         self.add_message_handler(2, self.on_request)
         self.replica = state if not state is None else CrdtSet()
         self.inner_replicas = {}
+        # ids of inner replicas that were removed, states that still come in for them are ignored
+        self.removed_replicas = set()
         self.message_fragments = dict()
         self.chaos_probability = 0
         self.reset_stats()
         self.expected_replicas = dict()
+        # both off by default, every broadcast sends the full state as it always did
+        self.use_deltas = False
+        self.use_reconciliation = False
+        # replica id -> number of broadcasts done, to interleave full states with the deltas
+        self.broadcast_counts = dict()
+        # (replica id, origin replica) -> seq of the last delta or full state merged from that origin
+        self.delta_seqs = dict()
+        # mids of the peers that hold replicas, garbage collection needs all of them to agree so it only runs once
+        # these are known, see set_members
+        self.members = None
 
-    def broadcast_state(self, replicaid = None):
+    def get_replica(self, replicaid):
         if replicaid is None or len(replicaid) == 0:
-            replica = self.replica
-        else:
-            replica = self.inner_replicas[replicaid]
+            return self.replica
+        return self.inner_replicas[replicaid]
+
+    # stops keeping, and broadcasting, an inner replica
+    def remove_replica(self, replicaid: str) -> None:
+        self.inner_replicas.pop(replicaid, None)
+        self.removed_replicas.add(replicaid)
+
+    def broadcast_state(self, replicaid = None):
+        replica = self.get_replica(replicaid)
+        if not self.members is None:
+            replica.compact(self.members)
         if not replica.Dirty:
             return
         broadcast_time = perf_counter()
-        buffer = pickle.dumps(replica)
+        buffer = self.encode_update(replicaid, replica)
         for p in self.get_peers():
             self.send_state(p, replicaid, buffer)
         replica.Dirty = False
         self.stats["last_broadcast_time"] = STATS_DECAY * self.stats["last_broadcast_time"] + STATS_DECAY_ALT * (perf_counter() - broadcast_time)
 
+    # encodes either the changes since the last broadcast, a digest or the full state of the replica
+    def encode_update(self, replicaid, replica) -> bytes:
+        if not isinstance(replica, CrdtSet):
+            return Codec.dumps(replica)
+        replicaid = replicaid or ""
+        count = self.broadcast_counts.get(replicaid, 0)
+        self.broadcast_counts[replicaid] = count + 1
+        # the delta is taken even when sending the full state, so the seq in the full state covers these changes
+        delta = replica.take_delta()
+        # a dirty replica without entry changes had its tombstones compacted or promoted, only the full state has that
+        if (not self.use_deltas and not self.use_reconciliation) or len(delta) == 0 or count % FULL_STATE_INTERVAL == 0:
+            self.stats["full_count"] += 1
+            return Codec.dumps(replica)
+        if self.use_reconciliation:
+            self.stats["digest_count"] += 1
+            return Codec.dumps(replica.digest())
+        self.stats["delta_count"] += 1
+        return Codec.dumps(delta)
+
+    # Declares which peers hold replicas, besides us. The set is taken as is: a member that is never heard from stops
+    # garbage collection, a replica that isn't a member can have its removed entries come back.
+    def set_members(self, members: Iterable[bytes]) -> None:
+        self.members = set(members)
+
     def send_state(self, peer, replicaid, buffer):
         id = randint(0, 2 ** 31 - 1)
         fragments = int(ceil(len(buffer) / FRAGMENT_MAX_SIZE))
@@ -84,12 +140,16 @@ class CrdtCommunity(Community):
             self.ez_send(peer, CrdtStateMessage(id, 1, n, fragments, replicaid, buffer[offset:offset+length]))
 
     def reset_stats(self):
-        self.stats = {"merge_count": 0, "drop_count": 0, "pass_count": 0, "last_merge_time": 0, "last_unpickle_time": 0, "last_buffer_fragment_time": 0, "last_broadcast_time": 0}
+        self.stats = {"merge_count": 0, "drop_count": 0, "pass_count": 0, "last_merge_time": 0, "last_unpickle_time": 0, "last_buffer_fragment_time": 0, "last_broadcast_time": 0, "delta_count": 0, "full_count": 0, "digest_count": 0, "reconcile_fallback_count": 0, "reject_count": 0}
 
     @lazy_wrapper(CrdtRequestMessage)
     def on_request(self, peer, payload):
         print("Community getting request from %r" % peer)
-        self.broadcast_state(str(payload.replica_id, "utf8"))
+        replicaid = str(payload.replica_id, "utf8")
+        if len(replicaid) > 0 and not replicaid in self.inner_replicas:
+            return
+        # the requester is missing state, answer with the full state whether or not we have changes
+        self.send_state(peer, replicaid, Codec.dumps(self.get_replica(replicaid)))
 
     @lazy_wrapper(CrdtStateMessage)
     def on_state(self, peer, payload):
@@ -123,7 +183,12 @@ class CrdtCommunity(Community):
             self.stats["pass_count"] += 1
 
         pickle_time = perf_counter()
-        other = pickle.loads(buffer)
+        try:
+            other = Codec.loads(buffer)
+        except Codec.CodecError as e:
+            print("Community dropped malformed state from %r: %s" % (peer, e))
+            self.stats["reject_count"] += 1
+            return
         self.stats["last_unpickle_time"] = STATS_DECAY * self.stats["last_unpickle_time"] + STATS_DECAY_ALT * (perf_counter() - pickle_time)
         #if type(other) != type(self.replica):
         #    return
@@ -133,25 +198,74 @@ class CrdtCommunity(Community):
         if len(replicaid) == 0:
             target = self.replica
         else:
+            if replicaid in self.removed_replicas:
+                return
             if not replicaid in self.inner_replicas:
                 self.inner_replicas[replicaid] = CrdtSet()
 
             target = self.inner_replicas[replicaid]
 
+        if isinstance(other, CrdtDelta):
+            self.merge_delta(peer, replicaid, target, other)
+            return
+        if isinstance(other, InvertibleBloomFilter):
+            self.reconcile(peer, replicaid, target, other)
+            return
+        if isinstance(other, CrdtReconciliation):
+            delta = target.answer(other)
+            if len(delta) > 0:
+                self.send_state(peer, replicaid, Codec.dumps(delta))
+            return
+
         merge_time = perf_counter()
-        target.combine(other)
+        try:
+            target.combine(other)
+        except ValueError as e:
+            # a state that decoded fine can still be incompatible with ours, its tombstones of another kind or shape
+            print("Community dropped incompatible state from %r: %s" % (peer, e))
+            self.stats["reject_count"] += 1
+            return
+        target.acknowledge(peer.mid, other)
         self.stats["last_merge_time"] = STATS_DECAY * self.stats["last_merge_time"] + STATS_DECAY_ALT * (perf_counter() - merge_time)
         self.stats["merge_count"] += 1
+        if isinstance(other, CrdtSet):
+            key = (replicaid, other.replica_id)
+            self.delta_seqs[key] = max(self.delta_seqs.get(key, 0), other.delta_seq)
         if replicaid in self.expected_replicas:
             print("Replica %s is expected! Setting result." % replicaid)
             sys.stdout.flush()
-            self.expected_replicas[replicaid].set_result(target)
+            if not self.expected_replicas[replicaid].done():
+                self.expected_replicas[replicaid].set_result(target)
             del self.expected_replicas[replicaid]
 
+    # Applies a delta, when deltas from its origin went missing the full state is requested from the sender.
+    # The delta itself is applied regardless, it never conflicts with state we don't have yet.
+    def merge_delta(self, peer, replicaid, target, delta):
+        key = (replicaid, delta.origin)
+        if self.delta_seqs.get(key, 0) < delta.seq - 1:
+            print("Community missed deltas of %s, requesting full state from %r" % (delta.origin, peer))
+            self.ez_send(peer, CrdtRequestMessage(replicaid.encode()))
+        self.delta_seqs[key] = max(self.delta_seqs.get(key, 0), delta.seq)
+
+        merge_time = perf_counter()
+        target.apply_delta(delta)
+        self.stats["last_merge_time"] = STATS_DECAY * self.stats["last_merge_time"] + STATS_DECAY_ALT * (perf_counter() - merge_time)
+        self.stats["merge_count"] += 1
+
+    def reconcile(self, peer, replicaid, target, digest):
+        reconciliation = target.reconcile(digest)
+        if reconciliation is None:
+            print("Community can't decode the difference with %r, exchanging full state" % peer)
+            self.stats["reconcile_fallback_count"] += 1
+            self.send_state(peer, replicaid, Codec.dumps(target))
+            self.ez_send(peer, CrdtRequestMessage(replicaid.encode()))
+        elif len(reconciliation) > 0:
+            self.send_state(peer, replicaid, Codec.dumps(reconciliation))
+
     async def get(self, replica_id):
         if replica_id is None:
             replica_id = ""
-        if not replica_id in self.expected_replicas:
+        if not replica_id in self.expected_replicas or self.expected_replicas[replica_id].done():
             expectation = Future()
             # send request message
             self.expected_replicas[replica_id] = expectation
@@ -160,7 +274,8 @@ class CrdtCommunity(Community):
                 print("Community getting %s, sending request to %r" % (replica_id, p))
                 self.ez_send(p, CrdtRequestMessage(replica_id.encode()))
 
-        return await self.expected_replicas[replica_id]
+        # several lookups can wait for the same replica, one of them being cancelled must not cancel the others
+        return await shield(self.expected_replicas[replica_id])
 
     def _verify_signature(self, auth: BinMemberAuthenticationPayload, data: bytes) -> Tuple[bool, bytes]:
         return True, data[2 + len(auth.public_key_bin):-default_eccrypto.get_signature_length(default_eccrypto.key_from_public_bin(auth.public_key_bin))]
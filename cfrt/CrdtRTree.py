@@ -1,5 +1,8 @@
-from typing import Sequence, Union, Tuple, Iterator
-from random import randint, sample
+from typing import AsyncIterator, Dict, Iterable, List, Sequence, Union, Tuple, Iterator
+from asyncio import Semaphore, as_completed, ensure_future, gather
+from bisect import bisect_left, bisect_right
+from heapq import heapify, heappop, heapreplace, merge as merge_sorted
+from random import randint
 from experiments.cfrt.thesis.CrdtSet import CrdtSet
 
 def prefix_count(left: str, right: str) -> int:
@@ -16,22 +19,146 @@ def weighted_prefix_score(left: str, right: str) -> float:
         finger += 1
     return (1 << (finger+8)) + (255 - abs(left[finger].encode()[0] - right[finger].encode()[0]))
 
-def get(node_id: str) -> Union["CrdtRTree", None]:
-    return None
-
-async def get_async(node_id: str) -> Union["CrdtRTree", None]:
-    return None
-
-def set_root(node_id: str):
-    pass
-
-def add_node(node: "CrdtRTree"):
-    pass
-
-split_count = 0
-merge_count = 0
+# the smallest string that is larger than every string starting with prefix, None if there is none
+def prefix_end(prefix: str) -> Union[str, None]:
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if len(prefix) == 0:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# whether key lies below the upper bound high of a scan, a high of None has no upper bound
+def below(key: str, high: Union[str, None], closed: bool) -> bool:
+    return high is None or key < high or (closed and key == high)
+
+# heapq.merge for async iterators of (key, value) pairs, only ever awaits the iterator the next pair comes from
+async def merge_sorted_async(iterators: List[AsyncIterator[Tuple[str, str]]]) -> AsyncIterator[Tuple[str, str]]:
+    heap = []
+    for i, iterator in enumerate(iterators):
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            continue
+        heap.append((item[0], i, item))
+    heapify(heap)
+    while len(heap) > 0:
+        _, i, item = heap[0]
+        yield item
+        try:
+            item = await iterators[i].__anext__()
+            heapreplace(heap, (item[0], i, item))
+        except StopAsyncIteration:
+            heappop(heap)
+
+# number of overlapping children query_leaf_item_async fetches and searches at the same time, 1 searches them in turn
+QUERY_CONCURRENCY = 4
+
+# Default fanout configuration of a tree: the split policy its nodes use and the ranges they draw their split and join
+# thresholds from. The thresholds are drawn at random per node, so concurrently created replicas don't all split at once.
+DEFAULT_SPLIT_POLICY = "median"
+DEFAULT_SPLIT_THRESHOLDS = (24, 48)
+DEFAULT_JOIN_THRESHOLDS = (8, 12)
+# number of nodes the k-split policy spreads an overfull node over
+DEFAULT_SPLIT_WAYS = 3
+
+# Split policies divide the ordered entries of an overfull node in groups, the first stays in the node and every other
+# one moves to a new sibling. They return None when the node can't be split.
+
+# Cuts at the median of all bounds, entries that straddle it go to the side whose bound shares the longer prefix with it
+def split_median(node: "CrdtRTree", entries: Sequence["CrdtRTreeEntry"]) -> Union[List[List["CrdtRTreeEntry"]], None]:
+    boundaries = set()
+    for item in entries:
+        if item.key_min != "None":
+            boundaries.add(item.key_min)
+        if item.key_max != "None":
+            boundaries.add(item.key_max)
+    if len(boundaries) < 2:
+        # can't split empty or singular value node.
+        return None
+    boundaries = sorted(boundaries)
+    median = boundaries[len(boundaries) >> 1]
+
+    left = []
+    right = []
+    for item in entries:
+        if item.key_min == "None":
+            left.append(item)
+        elif item.key_max == "None":
+            right.append(item)
+        elif item.key_max < median:
+            left.append(item)
+        elif item.key_min > median:
+            right.append(item)
+        elif prefix_count(item.key_min, median) < prefix_count(item.key_max, median):
+            left.append(item)
+        else:
+            right.append(item)
+    if len(left) == 0 or len(right) == 0:
+        return split_halves(entries)
+    return [left, right]
+
+# cuts the entries in two halves by position
+def split_halves(entries: Sequence["CrdtRTreeEntry"]) -> Union[List[List["CrdtRTreeEntry"]], None]:
+    if len(entries) < 2:
+        return None
+    half = len(entries) >> 1
+    return [list(entries[:half]), list(entries[half:])]
+
+# The positions to consider for a cut in two. Both sides have to stay above the join threshold any node can draw, or
+# the new node merges right back and the split starts over. Only the middle is left when that can't be done.
+def cut_positions(node: "CrdtRTree", entries: Sequence["CrdtRTreeEntry"]) -> range:
+    low = max(1, node.context.join_thresholds[1] + 1)
+    high = len(entries) - node.context.join_thresholds[1]
+    if low >= high:
+        return range(len(entries) >> 1, (len(entries) >> 1) + 1)
+    return range(low, high)
+
+# Cuts between the two neighbouring entries that share the shortest prefix, closest to the middle among those. The two
+# nodes then cover key ranges with as long a common prefix as possible, which is what routing by prefix relies on.
+def split_prefix(node: "CrdtRTree", entries: Sequence["CrdtRTreeEntry"]) -> Union[List[List["CrdtRTreeEntry"]], None]:
+    if len(entries) < 2:
+        return None
+    middle = len(entries) >> 1
+    cut = min(cut_positions(node, entries), key=lambda i: (prefix_count(entries[i - 1].key_max, entries[i].key_min), abs(i - middle)))
+    return [list(entries[:cut]), list(entries[cut:])]
+
+# Cuts in split_ways consecutive groups of about the same size, fewer when the groups would not stay above the join
+# threshold any new node can draw. Nodes that fill up fast split less often.
+def split_k(node: "CrdtRTree", entries: Sequence["CrdtRTreeEntry"]) -> Union[List[List["CrdtRTreeEntry"]], None]:
+    ways = min(node.context.split_ways, len(entries) // (max(node.context.join_thresholds[1], 0) + 1))
+    if ways < 2:
+        return split_halves(entries)
+    return [list(entries[(i * len(entries)) // ways:((i + 1) * len(entries)) // ways]) for i in range(0, ways)]
+
+# Cuts where the ranges of the two sides overlap least: preferably where they are disjoint, otherwise where the fewest
+# entries on the right start before the left side ends. Ties go to the cut closest to the middle.
+def split_overlap(node: "CrdtRTree", entries: Sequence["CrdtRTreeEntry"]) -> Union[List[List["CrdtRTreeEntry"]], None]:
+    if len(entries) < 2:
+        return None
+    mins = [item.key_min for item in entries]
+    reach = []
+    for item in entries:
+        reach.append(item.key_max if len(reach) == 0 or item.key_max > reach[-1] else reach[-1])
+    middle = len(entries) >> 1
+    # the entries are ordered by key_min, so the right side entries starting at or before the end of the left side
+    # are the ones right after the cut
+    cut = min(cut_positions(node, entries), key=lambda i: (bisect_right(mins, reach[i - 1], i) - i, abs(i - middle)))
+    return [list(entries[:cut]), list(entries[cut:])]
+
+SPLIT_POLICIES = {
+    "median": split_median,
+    "prefix": split_prefix,
+    "k-split": split_k,
+    "overlap": split_overlap,
+}
+
+# the order nodes keep their entries in
+def entry_order(entry: "CrdtRTreeEntry") -> Tuple[str, str, str]:
+    return entry.key_min, entry.key_max, entry.value
 
 class CrdtRTreeEntry:
+    # every node replica holds these for all its children, no per instance dict
+    __slots__ = ("key_min", "key_max", "value")
+
     def __init__(self, key: Tuple[str, str], value: str):
         self.key_min = key[0]
         self.key_max = key[1]
@@ -53,68 +180,321 @@ class CrdtRTreeEntry:
     def key(self) -> str:
         return str(self.key_min) + "-" + str(self.key_max)
 
-    @property
-    def target(self) -> Union["CrdtRTree", None]:
-        return get(self.value)
-
     @property
     def is_leaf(self) -> bool:
         return self.key_min != "None" and self.key_min == self.key_max
 
 
+# Everything of a tree beyond its nodes: how node ids resolve to nodes, where new nodes and the root pointer go, how
+# nodes get scheduled for a check, the fanout configuration and the split and merge counters. Every node is bound to
+# the context of its tree, so one process can hold several trees.
+# This context keeps the nodes in memory, hosts that keep them elsewhere, such as in the replicas of a community,
+# override get, get_async, add_node and set_root. Resolved nodes are cached in nodes either way.
+class CrdtRTreeContext:
+    def __init__(self, policy: str = None, split_range: Tuple[int, int] = None, join_range: Tuple[int, int] = None, split_ways: int = None) -> None:
+        # content id -> node
+        self.nodes = dict()
+        self.root_id = None
+        self.split_count = 0
+        self.merge_count = 0
+        self.split_policy = DEFAULT_SPLIT_POLICY
+        self.split_thresholds = DEFAULT_SPLIT_THRESHOLDS
+        self.join_thresholds = DEFAULT_JOIN_THRESHOLDS
+        self.split_ways = DEFAULT_SPLIT_WAYS
+        self.configure(policy, split_range, join_range, split_ways)
+
+    # Sets the fanout configuration of the nodes created from now on, thresholds are (low, high) ranges and split_ways
+    # is the number of nodes the k-split policy spreads an overfull node over.
+    def configure(self, policy: str = None, split_range: Tuple[int, int] = None, join_range: Tuple[int, int] = None, split_ways: int = None) -> None:
+        if not policy is None:
+            if not policy in SPLIT_POLICIES:
+                raise ValueError("Unknown split policy %r" % policy)
+            self.split_policy = policy
+        if not split_ways is None:
+            if split_ways < 2:
+                raise ValueError("A node has to be split over at least 2 nodes, not %r" % split_ways)
+            self.split_ways = split_ways
+        if not split_range is None:
+            self.split_thresholds = split_range
+        if not join_range is None:
+            self.join_thresholds = join_range
+
+    def get(self, node_id: str) -> Union["CrdtRTree", None]:
+        return self.nodes.get(node_id)
+
+    async def get_async(self, node_id: str) -> Union["CrdtRTree", None]:
+        return self.get(node_id)
+
+    def add_node(self, node: "CrdtRTree") -> None:
+        self.nodes[node.content_id] = node
+
+    def set_root(self, node_id: str) -> None:
+        self.root_id = node_id
+
+    # forgets a node that is no longer part of the tree
+    def remove_node(self, node_id: str) -> None:
+        self.nodes.pop(node_id, None)
+
+    # queues a node that needs a do_check, height is its distance to the leaves as far as known
+    def schedule(self, node: "CrdtRTree", height: int) -> None:
+        pass
+
+    @property
+    def root(self) -> Union["CrdtRTree", None]:
+        if self.root_id is None:
+            return None
+        return self.get(self.root_id)
+
+    # creates an empty tree of a single node
+    def init_root(self) -> "CrdtRTree":
+        root = CrdtRTree(self)
+        self.add_node(root)
+        self.set_root(root.content_id)
+        return root
+
+    # Builds a tree bottom up from (key, value) pairs and returns its root, or None when there are no pairs. The pairs
+    # are packed into leaves in key order, then the leaves into inner nodes and so on until a single node is left.
+    # Every node is filled to 3/4 of its split threshold, which leaves room for inserts before it splits. When the last
+    # node of a level would end up at or below the join threshold, the one before it takes the rest if that doesn't
+    # make it split, otherwise the two share the entries. Every node is registered through add_node, the root through
+    # set_root. The tree has to be empty, an empty root that was there before is removed.
+    def bulk_load(self, items: Iterable[Tuple[str, str]], presorted: bool = False) -> Union["CrdtRTree", None]:
+        previous = self.root
+        if not previous is None and len(previous) > 0:
+            raise ValueError("Can only bulk load an empty tree, the root has %s entries" % len(previous))
+        if not presorted:
+            items = sorted(items, key=lambda pair: pair[0])
+        level = self.pack_level([CrdtRTreeEntry((key, key), value) for key, value in items])
+        if len(level) == 0:
+            return None
+        while len(level) > 1:
+            parents = self.pack_level([CrdtRTreeEntry(node.compute_range(), node.content_id) for node in level])
+            children = {node.content_id: node for node in level}
+            for parent in parents:
+                for entry in parent:
+                    children[entry.value].add_parent(parent.content_id)
+            level = parents
+        self.set_root(level[0].content_id)
+        if not previous is None and len(previous) == 0:
+            self.remove_node(previous.content_id)
+        return level[0]
+
+    # Packs entries, in order, into new nodes. The join threshold of a node is only known once it exists, so the tail is
+    # held against the highest one it can get.
+    def pack_level(self, entries: List[CrdtRTreeEntry]) -> List["CrdtRTree"]:
+        nodes = []
+        finger = 0
+        join_threshold = self.join_thresholds[1]
+        while finger < len(entries):
+            node = CrdtRTree(self)
+            fill = min(node.split_threshold, max((node.split_threshold * 3) >> 2, join_threshold + 1))
+            remaining = len(entries) - finger
+            if remaining > fill and remaining - fill <= join_threshold:
+                if remaining <= node.split_threshold:
+                    fill = remaining
+                else:
+                    fill = max(join_threshold + 1, remaining >> 1)
+            node.state.add_many(entries[finger:finger + fill])
+            self.add_node(node)
+            nodes.append(node)
+            finger += fill
+        return nodes
+
+
+# A node keeps its child entries and parent ids mixed in one CrdtSet. Telling them apart takes a scan of the state, so
+# the node keeps views of it: the entries, the parents and, computed when asked for, the leaf flag, range and
+# children. Local changes update the views in place, any other change to the state, a combine with a remote replica or
+# a new state object, is noticed through the version of the state and rebuilds them on the next access.
+# The entries are kept ordered by key_min and key_max, so routing a key to a child and finding a key in a leaf bisect
+# rather than compare every entry.
 class CrdtRTree:
-    def __init__(self):
+    def __init__(self, context: CrdtRTreeContext = None):
+        self.context = context if not context is None else default_context
         self.state = CrdtSet()
-        self.split_threshold = randint(24, 48)
-        #self.split_threshold = randint(75, 100)
-        self.join_threshold = randint(8, 12)
-        #self.join_threshold = randint(20, 30)
+        self.view_state = None
+        self.view_version = -1
+        self.entries_view = ()
+        self.parents_view = ()
+        self.leaf_view = None
+        self.range_view = None
+        self.children_view = None
+        self.route_view = None
+        self.split_policy = self.context.split_policy
+        self.split_threshold = randint(*self.context.split_thresholds)
+        self.join_threshold = randint(*self.context.join_thresholds)
         self.content_id = str(randint(0, 2 ** 64 - 1))
         self.should_check = False
+        # distance to the leaves, as learned from the last operation that went through this node
+        self.height = 0
         self.touched = False
 
     def __len__(self) -> int:
-        return len([item for item in self.state if type(item) is CrdtRTreeEntry])
+        return len(self.entries)
 
+    # the views are replaced rather than changed, so the node can be changed while iterating
     def __iter__(self) -> Sequence[CrdtRTreeEntry]:
-        for item in list(self.state):
-            if type(item) is CrdtRTreeEntry:
-                yield item
+        return iter(self.entries)
+
+    @property
+    def entries(self) -> Sequence[CrdtRTreeEntry]:
+        self.refresh_views()
+        return self.entries_view
 
     @property
     def parents(self) -> Sequence[str]:
-        return [item for item in self.state if not type(item) is CrdtRTreeEntry]
+        self.refresh_views()
+        return self.parents_view
+
+    def refresh_views(self) -> None:
+        if self.view_state is self.state and self.view_version == self.state.version:
+            return
+        entries = []
+        parents = []
+        for item in self.state:
+            if type(item) is CrdtRTreeEntry:
+                entries.append(item)
+            else:
+                parents.append(item)
+        entries.sort(key=entry_order)
+        self.entries_view = tuple(entries)
+        self.parents_view = tuple(parents)
+        self.invalidate_views()
+        self.view_state = self.state
+        self.view_version = self.state.version
+
+    def invalidate_views(self) -> None:
+        self.leaf_view = None
+        self.range_view = None
+        self.children_view = None
+        self.route_view = None
+
+    # Applies a local change to the state and, when the views were up to date before, to the views as well. Returns
+    # whether the state changed.
+    def change_state(self, change, *args) -> bool:
+        fresh = self.view_state is self.state and self.view_version == self.state.version
+        version = self.state.version
+        change(*args)
+        if version == self.state.version:
+            return False
+        if fresh:
+            self.view_version = self.state.version
+        return fresh
 
     def add_parent(self, par):
-        self.state.add(par)
+        if self.change_state(self.state.add, par):
+            self.parents_view = self.parents_view + (par, )
 
     def remove_parent(self, par):
-        self.state.remove(par)
+        if self.change_state(self.state.remove, par):
+            self.parents_view = tuple(parent for parent in self.parents_view if parent != par)
 
     def add(self, item: CrdtRTreeEntry) -> None:
-        self.state.add(item)
+        if self.change_state(self.state.add, item):
+            i = self.entry_position(item)
+            self.entries_view = self.entries_view[:i] + (item, ) + self.entries_view[i:]
+            if self.leaf_view and not item.is_leaf:
+                self.leaf_view = False
+            self.range_view = None
+            self.children_view = None
+            self.route_view = None
+
+    # where item goes in the ordered entries
+    def entry_position(self, item: CrdtRTreeEntry) -> int:
+        order = entry_order(item)
+        low = 0
+        high = len(self.entries_view)
+        while low < high:
+            middle = (low + high) >> 1
+            if entry_order(self.entries_view[middle]) < order:
+                low = middle + 1
+            else:
+                high = middle
+        return low
 
     def remove(self, item: CrdtRTreeEntry) -> None:
-        self.state.remove(item)
+        if self.change_state(self.state.remove, item):
+            self.entries_view = tuple(entry for entry in self.entries_view if entry != item)
+            self.invalidate_views()
 
     def remove_values(self, value: str) -> None:
-        for item in list(self):
-            if item.value == value:
-                self.state.remove(item)
+        removed = [item for item in self if item.value == value]
+        if self.change_state(self.state.remove_many, removed):
+            self.entries_view = tuple(entry for entry in self.entries_view if entry.value != value)
+            self.invalidate_views()
 
     def is_leaf_node(self):
-        for item in self:
-            if not item.is_leaf:
-                return False
-        return True
+        self.refresh_views()
+        if self.leaf_view is None:
+            self.leaf_view = all(item.is_leaf for item in self.entries_view)
+        return self.leaf_view
+
+    # Returns the key_min of every entry, the running maximum of their key_max and every key bound together with its
+    # entry, sorted. The running maximum tells when no entry further to the left can contain a key anymore.
+    def routes(self) -> Tuple[List[str], List[str], List[Tuple[str, int]]]:
+        self.refresh_views()
+        if self.route_view is None:
+            mins = []
+            reach = []
+            bounds = []
+            for i, item in enumerate(self.entries_view):
+                mins.append(item.key_min)
+                reach.append(item.key_max if len(reach) == 0 or item.key_max > reach[-1] else reach[-1])
+                bounds.append((item.key_min, i))
+                bounds.append((item.key_max, i))
+            bounds.sort()
+            self.route_view = (mins, reach, bounds)
+        return self.route_view
+
+    # the entries with key_min <= key <= key_max, in order
+    def containers(self, key: str) -> List[CrdtRTreeEntry]:
+        mins, reach, _ = self.routes()
+        result = []
+        i = bisect_right(mins, key) - 1
+        while i >= 0 and reach[i] >= key:
+            if self.entries_view[i].key_max >= key:
+                result.append(self.entries_view[i])
+            i -= 1
+        result.reverse()
+        return result
+
+    # The entry with a bound sharing the longest prefix with key. Of all strings, the ones sharing the longest prefix
+    # with key sort right next to it, so only the bounds on either side of key need comparing.
+    def closest(self, key: str) -> Union[CrdtRTreeEntry, None]:
+        _, _, bounds = self.routes()
+        i = bisect_left(bounds, (key, ))
+        candidates = bounds[max(0, i - 1):i + 1]
+        if len(candidates) == 0:
+            return None
+        return self.entries_view[max(candidates, key=lambda bound: prefix_count(bound[0], key))[1]]
+
+    # the leaf entries for key, these are next to each other in the ordered entries
+    def leaf_entries(self, key: str) -> List[CrdtRTreeEntry]:
+        mins, _, _ = self.routes()
+        result = []
+        i = bisect_left(mins, key)
+        while i < len(mins) and mins[i] == key:
+            if self.entries_view[i].key_max == key:
+                result.append(self.entries_view[i])
+            i += 1
+        return result
 
     def get_parents(self) -> Sequence["CrdtRTree"]:
-        return [get(parent) for parent in self.parents]
+        return [self.context.get(parent) for parent in self.parents]
+
+    # the node an entry refers to
+    def child(self, item: CrdtRTreeEntry) -> Union["CrdtRTree", None]:
+        return self.context.get(item.value)
 
     def compute_range(self) -> Tuple[str, str]:
+        self.refresh_views()
+        if self.range_view is None:
+            self.range_view = self.scan_range()
+        return self.range_view
+
+    def scan_range(self) -> Tuple[str, str]:
         self_min = None
         self_max = None
-        for item in self:
+        for item in self.entries_view:
             if self_min is None or (item.key_min != "None" and item.key_min < self_min):
                 self_min = item.key_min
             if self_max is None or (item.key_max != "None" and item.key_max > self_max):
@@ -122,14 +502,22 @@ class CrdtRTree:
         return str(self_min), str(self_max)
 
     def compute_children(self) -> Sequence[str]:
-        result = []
-        for item in self:
-            if not item.is_leaf and not item.value in result:
-                result.append(item.value)
-        return result
-
-    def check(self):
+        self.refresh_views()
+        if self.children_view is None:
+            result = []
+            seen = set()
+            for item in self.entries_view:
+                if not item.is_leaf and not item.value in seen:
+                    seen.add(item.value)
+                    result.append(item.value)
+            self.children_view = tuple(result)
+        return self.children_view
+
+    def check(self, height: int = None):
+        if not height is None:
+            self.height = height
         self.should_check = True
+        self.context.schedule(self, self.height)
 
     def do_check(self):
         self.should_check = False
@@ -137,7 +525,7 @@ class CrdtRTree:
         # Figure out if one of our parents doesn't actually refer to us. If so it's not our parent
         if len(self.parents) > 1:
             for old_parent in self.parents:
-                if get(old_parent) is None or not self.content_id in get(old_parent).compute_children():
+                if self.context.get(old_parent) is None or not self.content_id in self.context.get(old_parent).compute_children():
                     self.remove_parent(old_parent)
 
         # TODO: Check if any of our children doesn't have self as parent?
@@ -162,9 +550,9 @@ class CrdtRTree:
                 # children are not disjoint, merge and hope for a better split
                 if right.key_min <= left.key_min and left.key_max <= right.key_max:
                     # left is contained in right
-                    left.target.merge(sibling=right)
+                    self.child(left).merge(sibling=right)
                 else:
-                    right.target.merge(sibling=left)
+                    self.child(right).merge(sibling=left)
                 # either left or right has changed and our entries list is stale, but we cant figure out the new values.
                 # We skip the next pair since that would have left as right in the next loop, we'll eventually get it in a later round
                 finger -= 2
@@ -179,6 +567,8 @@ class CrdtRTree:
                 continue
             parent.remove_values(self.content_id)
             parent.add(CrdtRTreeEntry(my_range, self.content_id))
+            # the range of the parent may have changed along
+            parent.check(self.height + 1)
 
         if len(self) == 0:
             self.delete()
@@ -191,14 +581,13 @@ class CrdtRTree:
         #del world_content[self.content_id]
 
     def merge(self, sibling=None):
-        global merge_count
         if len(self.parents) == 0:
             # we are root, there are no siblings to merge with.
             # however if we only have 1 child under root and we're not at the bottom, the child should become the new root
             if len(self) == 1 and not self.is_leaf_node():
                 entry = list(self)[0]
-                entry.target.remove_parent(self.content_id)
-                set_root(entry.value)
+                self.child(entry).remove_parent(self.content_id)
+                self.context.set_root(entry.value)
             return
 
         # select sibling
@@ -220,140 +609,166 @@ class CrdtRTree:
             if sibling is None:
                 return
 
-        merge_count += 1
+        self.context.merge_count += 1
         self.delete()
         for item in self:
-            sibling.target.add(item)
+            self.child(sibling).add(item)
             if not item.is_leaf:
-                item.target.add_parent(sibling.value)
-                item.target.remove_parent(self.content_id)
-        sibling.target.do_check()
-
+                self.child(item).add_parent(sibling.value)
+                self.child(item).remove_parent(self.content_id)
+        target = self.child(sibling)
+        target.height = self.height
+        target.do_check()
+
+    # splits this node according to its split policy, the first group of entries stays and every other group moves to a
+    # new sibling
     def split(self):
-        global split_count
-        boundaries = []
-        for item in self:
-            if item.key_min != "None" and not item.key_min in boundaries:
-                boundaries.append(item.key_min)
-            if item.key_max != "None" and not item.key_max in boundaries:
-                boundaries.append(item.key_max)
-        boundaries.sort()
-        if len(boundaries) < 2:
-            # can't split empty or singular value node.
+        groups = SPLIT_POLICIES[self.split_policy](self, self.entries)
+        if groups is None:
+            return
+        groups = [group for group in groups if len(group) > 0]
+        if len(groups) < 2:
             return
 
-        split_count += 1
-        median = boundaries[len(boundaries) >> 1]
-
-        left = []
-        right = []
-        for item in self:
-            if item.key_min == "None":
-                left.append(item)
-            elif item.key_max == "None":
-                right.append(item)
-            elif item.key_max < median:
-                left.append(item)
-            elif item.key_min > median:
-                right.append(item)
-            elif prefix_count(item.key_min, median) < prefix_count(item.key_max, median):
-                left.append(item)
-            else:
-                right.append(item)
-
-        if len(left) == 0 or len(right) == 0:
-            full = list(self)
-            left = sample(full, self.split_threshold >> 1)
-            right = [item for item in full if not item in left]
-
+        self.context.split_count += 1
         if len(self.parents) == 0:
-            new_parent = CrdtRTree()
-            add_node(new_parent)
+            new_parent = CrdtRTree(self.context)
+            self.context.add_node(new_parent)
             self.add_parent(new_parent.content_id)
-            set_root(new_parent.content_id)
-
-        split = right
-        #TODO: this way only splits off the right, should also split to the left?
-        other = CrdtRTree()
-        add_node(other)
-        for parent in self.parents:
-            other.add_parent(parent)
-
-        for item in split:
-            other.state.add(item)
-            if not item.is_leaf:
-                item.target.add_parent(other.content_id)
-                item.target.remove_parent(self.content_id)
-            self.state.remove(item)
-
-        # force other to register entry in parent
-        other.do_check()
-
-    def add_leaf_item(self, key: str, value: str) -> None:
+            self.context.set_root(new_parent.content_id)
+
+        for split in groups[1:]:
+            other = CrdtRTree(self.context)
+            self.context.add_node(other)
+            for parent in self.parents:
+                other.add_parent(parent)
+
+            other.state.add_many(split)
+            for item in split:
+                if not item.is_leaf:
+                    self.child(item).add_parent(other.content_id)
+                    self.child(item).remove_parent(self.content_id)
+            self.state.remove_many(split)
+
+            # force other to register entry in parent
+            other.height = self.height
+            other.do_check()
+
+    # returns the height of this node
+    def add_leaf_item(self, key: str, value: str) -> int:
+        height = 0
         if self.is_leaf_node():
             self.add(CrdtRTreeEntry((key, key), value))
         else:
-            containers = [item for item in self if item.key_min <= key <= item.key_max]
+            containers = self.containers(key)
             if len(containers) == 0:
-                containers = list(self)
-            entry = sorted(containers, key=lambda x: -max(prefix_count(x.key_min, key), prefix_count(x.key_max, key)))[0]
-            entry.target.add_leaf_item(key, value)
-        self.check()
-
-    def del_leaf_item(self, key: str) -> None:
+                entry = self.closest(key)
+            else:
+                entry = max(containers, key=lambda x: max(prefix_count(x.key_min, key), prefix_count(x.key_max, key)))
+            height = self.child(entry).add_leaf_item(key, value) + 1
+        self.check(height)
+        return height
+
+    # returns the height of this node
+    def del_leaf_item(self, key: str) -> int:
+        height = 0
         if self.is_leaf_node():
-            for item in list(self):
-                if item.key_min == key and item.key_max == key:
-                    self.remove(item)
+            for item in self.leaf_entries(key):
+                self.remove(item)
         else:
-            for item in list(self):
-                if item.key_min <= key <= item.key_max:
-                    item.target.del_leaf_item(key)
-        self.check()
+            height = self.height
+            for item in self.containers(key):
+                height = max(height, self.child(item).del_leaf_item(key) + 1)
+        self.check(height)
+        return height
 
     def query_leaf_item(self, key: str) -> Union[str, None]:
         if self.is_leaf_node():
-            for item in list(self):
-                if item.key_min == key and item.key_max == key:
-                    return item.value
+            for item in self.leaf_entries(key):
+                return item.value
         else:
             result = None
-            for item in self:
-                if item.key_min <= key <= item.key_max:
-                    result = item.target.query_leaf_item(key)
-                    if not result is None:
-                        break
+            for item in self.containers(key):
+                result = self.child(item).query_leaf_item(key)
+                if not result is None:
+                    break
             return result
 
-    async def query_leaf_item_async(self, key: str) -> Union[str, None]:
+    # When several children contain the key, up to concurrency of them are searched at the same time. The first hit is
+    # returned and the searches still running are cancelled.
+    async def query_leaf_item_async(self, key: str, concurrency: int = QUERY_CONCURRENCY, fetches: Semaphore = None) -> Union[str, None]:
         if self.is_leaf_node():
-            for item in list(self):
-                if item.key_min == key and item.key_max == key:
-                    return item.value
-        else:
-            result = None
-            for item in self:
-                if item.key_min <= key <= item.key_max:
-                    target = await get_async(item.value)
-                    if target is None:
-                        continue
-                    result = await target.query_leaf_item_async(key)
-                    if not result is None:
-                        break
-            return result
-
+            for item in self.leaf_entries(key):
+                return item.value
+            return None
+        # the top call creates the semaphore and the whole search shares it, it is only held while fetching a node so
+        # it caps the fetches outstanding at once without a parent waiting on its own children
+        if fetches is None:
+            fetches = Semaphore(max(1, concurrency))
+
+        async def search(item: CrdtRTreeEntry) -> Union[str, None]:
+            async with fetches:
+                target = await self.context.get_async(item.value)
+            if target is None:
+                return None
+            return await target.query_leaf_item_async(key, concurrency, fetches)
+
+        containers = self.containers(key)
+        if concurrency <= 1 or len(containers) <= 1:
+            for item in containers:
+                result = await search(item)
+                if not result is None:
+                    return result
+            return None
+
+        searches = [ensure_future(search(item)) for item in containers]
+        try:
+            for search_done in as_completed(searches):
+                result = await search_done
+                if not result is None:
+                    return result
+            return None
+        finally:
+            for search_task in searches:
+                search_task.cancel()
+
+    # Looks up many keys at once, returns a dict of key -> value, None for the keys that weren't found. The keys go down
+    # the tree together one level at a time, at every level the keys are split over the children that contain them and
+    # every child needed is fetched once, all of them concurrently.
+    async def query_many_async(self, keys: Iterable[str]) -> Dict[str, Union[str, None]]:
+        results = {key: None for key in keys}
+        frontier = [(self, sorted(results))]
+        while len(frontier) > 0:
+            # child id -> the keys to look up in it
+            wanted = {}
+            for node, node_keys in frontier:
+                if node.is_leaf_node():
+                    for key in node_keys:
+                        for item in node.leaf_entries(key):
+                            if results[key] is None:
+                                results[key] = item.value
+                else:
+                    for key in node_keys:
+                        if not results[key] is None:
+                            continue
+                        for item in node.containers(key):
+                            wanted.setdefault(item.value, []).append(key)
+            ids = list(wanted.keys())
+            targets = await gather(*(self.context.get_async(node_id) for node_id in ids))
+            frontier = [(target, wanted[node_id]) for node_id, target in zip(ids, targets) if not target is None]
+        return results
 
     def debug_print(self, level: int = 0) -> None:
         print('\t'*level + self.content_id + " parents [" + ", ".join(self.parents) + "]")
         for item in self.state.entries:
             if not type(item[0]) is CrdtRTreeEntry:
                 continue
-            print('\t' * level + " - [" + item[0].key_min + " - " + item[0].key_max + "] -> " + item[0].value + " (tag: " + item[1] + ")")
+            print('\t' * level + " - [" + item[0].key_min + " - " + item[0].key_max + "] -> " + item[0].value + " (tag: " + str(item[1]) + ")")
             if not item[0].is_leaf:
-                if get(item[0].value) is None:
+                if self.context.get(item[0].value) is None:
                     print("\t"*level + "\tMISSING!!!")
                 else:
-                    item[0].target.debug_print(level + 1)
+                    self.child(item[0]).debug_print(level + 1)
 
     def all_items(self) -> Iterator[Tuple[str, str]]:
         for item in self.state.entries:
@@ -362,9 +777,86 @@ class CrdtRTree:
             if item[0].is_leaf:
                 yield (item[0].key_min, item[0].value)
             else:
-                sub = get(item[0].value)
+                sub = self.context.get(item[0].value)
                 if sub is None:
                     continue
                 else:
                     for entry in sub.all_items():
                         yield entry
+
+    # Yields the (key, value) pairs with low <= key <= high in key order. Subtrees are only visited when their bounds
+    # overlap the range, and the pairs are streamed: a subtree is fetched when the scan gets to it.
+    def range_query(self, low: str, high: str) -> Iterator[Tuple[str, str]]:
+        return self.scan(low, high, True)
+
+    # yields the (key, value) pairs of the keys starting with prefix in key order
+    def prefix_scan(self, prefix: str) -> Iterator[Tuple[str, str]]:
+        return self.scan(prefix, prefix_end(prefix), False)
+
+    async def range_query_async(self, low: str, high: str) -> AsyncIterator[Tuple[str, str]]:
+        async for item in self.scan_async(low, high, True):
+            yield item
+
+    async def prefix_scan_async(self, prefix: str) -> AsyncIterator[Tuple[str, str]]:
+        async for item in self.scan_async(prefix, prefix_end(prefix), False):
+            yield item
+
+    # The entries overlapping the range from low up to high, which includes high when closed. These are split in runs
+    # of entries that overlap each other, consecutive runs hold keys in increasing order, within a run they have to be
+    # merged.
+    def scan_runs(self, low: str, high: Union[str, None], closed: bool) -> List[List[CrdtRTreeEntry]]:
+        mins, reach, _ = self.routes()
+        if high is None:
+            end = len(mins)
+        elif closed:
+            end = bisect_right(mins, high)
+        else:
+            end = bisect_left(mins, high)
+        runs = []
+        run_max = None
+        for item in self.entries_view[bisect_left(reach, low):end]:
+            if item.key_max < low:
+                continue
+            if len(runs) > 0 and item.key_min <= run_max:
+                runs[-1].append(item)
+                run_max = max(run_max, item.key_max)
+            else:
+                runs.append([item])
+                run_max = item.key_max
+        return runs
+
+    def scan(self, low: str, high: Union[str, None], closed: bool) -> Iterator[Tuple[str, str]]:
+        for run in self.scan_runs(low, high, closed):
+            if len(run) == 1:
+                yield from self.scan_entry(run[0], low, high, closed)
+            else:
+                yield from merge_sorted(*(self.scan_entry(item, low, high, closed) for item in run), key=lambda pair: pair[0])
+
+    def scan_entry(self, item: CrdtRTreeEntry, low: str, high: Union[str, None], closed: bool) -> Iterator[Tuple[str, str]]:
+        if item.is_leaf:
+            yield (item.key_min, item.value)
+        else:
+            target = self.child(item)
+            if not target is None:
+                yield from target.scan(low, high, closed)
+
+    async def scan_async(self, low: str, high: Union[str, None], closed: bool) -> AsyncIterator[Tuple[str, str]]:
+        for run in self.scan_runs(low, high, closed):
+            if len(run) == 1:
+                async for pair in self.scan_entry_async(run[0], low, high, closed):
+                    yield pair
+            else:
+                async for pair in merge_sorted_async([self.scan_entry_async(item, low, high, closed) for item in run]):
+                    yield pair
+
+    async def scan_entry_async(self, item: CrdtRTreeEntry, low: str, high: Union[str, None], closed: bool) -> AsyncIterator[Tuple[str, str]]:
+        if item.is_leaf:
+            yield (item.key_min, item.value)
+        else:
+            target = await self.context.get_async(item.value)
+            if not target is None:
+                async for pair in target.scan_async(low, high, closed):
+                    yield pair
+
+# the context of the nodes that are created without one
+default_context = CrdtRTreeContext()
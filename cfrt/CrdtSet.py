@@ -1,18 +1,88 @@
-from typing import Sequence
+from typing import Iterable, Sequence, Union
 from random import randint
-from experiments.cfrt.thesis.BloomFilter import BloomFilter
+from experiments.cfrt.thesis.BloomFilter import DEFAULT_HASH_FAMILY
+from experiments.cfrt.thesis.InvertibleBloomFilter import InvertibleBloomFilter
+from experiments.cfrt.thesis.TombstoneStore import create_store, combine_stores
+
+# upper bound on the number of tombstone verdicts remembered between combines
+VERDICT_CACHE_LIMIT = 65536
 
 # this class represents a Crdt set state
-# the basic idea is to keep track of deleted tags in a bloomfilter
-def generate_tag():
-    return "{0:032x}".format(randint(0, 2 ** 128))
+# the basic idea is to keep track of deleted tags in a tombstone store, by default a bloomfilter chain
+# Tags are 128 bit integers, those take about half the memory of their hex string form.
+def generate_tag() -> int:
+    return randint(0, 2 ** 128 - 1)
+
+# The changes a CrdtSet went through between two checkpoints: the entries it gained and the entries it lost.
+# Deltas are numbered per origin replica, a receiver that sees a gap in seq has missed one and needs the full state.
+class CrdtDelta:
+    __slots__ = ("origin", "seq", "entries", "removals")
+
+    def __init__(self, origin: int, seq: int, entries: set, removals: set) -> None:
+        self.origin = origin
+        self.seq = seq
+        self.entries = entries
+        self.removals = removals
+
+    def __len__(self):
+        return len(self.entries) + len(self.removals)
+
+# The answer to an other replica's digest: our entries it lacks, the tags of its entries that we removed and the tags of
+# its entries we want
+class CrdtReconciliation:
+    __slots__ = ("entries", "removed", "wanted")
+
+    def __init__(self, entries: set, removed: set, wanted: set) -> None:
+        self.entries = entries
+        self.removed = removed
+        self.wanted = wanted
+
+    def __len__(self):
+        return len(self.entries) + len(self.removed) + len(self.wanted)
 
 class CrdtSet:
-    def __init__(self) -> None:
+    def __init__(self, hash_family=DEFAULT_HASH_FAMILY, tombstones=None) -> None:
         self.entries = set()
-        self.bloomfilters = [ BloomFilter() ]
-        self.bloom_slack = 550
+        # element -> tag of that element in entries, or the set of its tags when it has several. The set costs four
+        # times the memory of the entry itself, so it is only created for the rare element that was added concurrently.
+        # This is derived state and not pickled
+        self.index = {}
         self.Dirty = True
+        self.replica_id = generate_tag()
+        self.tombstones = create_store(tombstones, self.replica_id, hash_family)
+        self.reset_verdicts()
+        # checkpoint number of the last delta taken, the changes since then are collected in delta_entries and
+        # delta_removals. Replicas that never had a delta taken don't pay for collecting them.
+        self.delta_seq = 0
+        self.delta_entries = None
+        self.delta_removals = None
+        # bumped on every change to entries, lets views derived from the entries tell whether they are stale. Not pickled
+        self.version = 0
+        # peer -> replica id of the state that peer last sent us, learned through acknowledge and not pickled
+        self.peer_replicas = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["index"]
+        del state["verdicts"]
+        del state["verdicts_store"]
+        del state["verdicts_generation"]
+        del state["delta_entries"]
+        del state["delta_removals"]
+        del state["version"]
+        del state["peer_replicas"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.index = {}
+        for entry in self.entries:
+            self.index_add(entry)
+        self.reset_verdicts()
+        self.delta_entries = None
+        self.delta_removals = None
+        self.peer_replicas = {}
+        self.version = 0
 
     def __str__(self):
         return "entries: [" + ", ".join(["[%s, %s]" % tup for tup in self.entries]) + "]"
@@ -28,44 +98,266 @@ class CrdtSet:
         return self.lookup(item)
 
     def lookup(self, entry) -> bool:
-        return entry in (key for (key, _) in self.entries)
+        return entry in self.index
+
+    # returns the tags of an element in entries
+    def tags(self, element) -> Sequence:
+        tags = self.index.get(element)
+        if tags is None:
+            return ()
+        if isinstance(tags, set):
+            return tags
+        return (tags, )
+
+    def index_add(self, entry) -> None:
+        tags = self.index.get(entry[0])
+        if tags is None:
+            self.index[entry[0]] = entry[1]
+        elif isinstance(tags, set):
+            tags.add(entry[1])
+        elif tags != entry[1]:
+            self.index[entry[0]] = {tags, entry[1]}
+
+    def index_remove(self, entry) -> None:
+        tags = self.index[entry[0]]
+        if isinstance(tags, set):
+            tags.discard(entry[1])
+            if len(tags) == 1:
+                self.index[entry[0]] = next(iter(tags))
+        elif tags == entry[1]:
+            del self.index[entry[0]]
+
+    def record_add(self, entry) -> None:
+        if not self.delta_entries is None:
+            self.delta_entries.add(entry)
+
+    def record_removal(self, entry) -> None:
+        if not self.delta_entries is None:
+            self.delta_entries.discard(entry)
+            self.delta_removals.add(entry)
 
     # add element to this node. Adds a random tag to the element to force OR characteristics
     def add(self, entry) -> None:
         if not self.lookup(entry):
             self.Dirty = True
-            self.entries.add((entry, generate_tag()))
+            self.version += 1
+            tag = generate_tag()
+            self.entries.add((entry, tag))
+            self.index[entry] = tag
+            self.record_add((entry, tag))
 
-    # removes an element from this node, and adds any removed tags to the bloomfilter
+    # adds several elements at once, elements that are already in the set or repeated in the batch are added once
+    def add_many(self, elements: Iterable) -> None:
+        added = []
+        for element in elements:
+            if not element in self.index:
+                tag = generate_tag()
+                self.index[element] = tag
+                added.append((element, tag))
+        if len(added) == 0:
+            return
+        self.Dirty = True
+        self.version += 1
+        self.entries.update(added)
+        if not self.delta_entries is None:
+            self.delta_entries.update(added)
+
+    # removes an element from this node, and adds any removed tags to the tombstones
     def remove(self, entry) -> None:
-        removals = [tup for tup in self.entries if tup[0] == entry]
-        for item in removals:
-            self.Dirty = True
-            self.entries.remove(item)
-            #print("Bloomfilter estimated size %s, max elements %s, bloom slack %s" %(self.bloomfilters[-1].estimated_size, self.bloomfilters[-1].max_elements, self.bloom_slack))
-            if self.bloomfilters[-1].estimated_size >= self.bloomfilters[-1].max_elements - self.bloom_slack:
-                self.bloomfilters.append(BloomFilter(max_elements=self.bloomfilters[-1].max_elements*2))
-            self.bloomfilters[-1].add(item[1])
+        tags = self.tags(entry)
+        if len(tags) == 0:
+            return
+        del self.index[entry]
+        self.Dirty = True
+        self.version += 1
+        for tag in tags:
+            self.entries.remove((entry, tag))
+            self.tombstones.add(tag)
+            self.record_removal((entry, tag))
+        self.promote_tombstones()
+
+    # removes several elements, their tags go into the tombstone store in one go
+    def remove_many(self, elements: Iterable) -> None:
+        removed = []
+        for element in elements:
+            tags = self.index.pop(element, None)
+            if isinstance(tags, set):
+                removed.extend((element, tag) for tag in tags)
+            elif not tags is None:
+                removed.append((element, tags))
+        if len(removed) == 0:
+            return
+        self.Dirty = True
+        self.version += 1
+        self.entries.difference_update(removed)
+        self.tombstones.add_many([entry[1] for entry in removed])
+        for entry in removed:
+            self.record_removal(entry)
+        self.promote_tombstones()
 
     # combines the changes contained in an other crdtset, that we have not yet seen, into this CrdtSets state
     def combine(self, other: "CrdtSet") -> None:
-        for n in range(0, max(len(self.bloomfilters), len(other.bloomfilters))):
-            left = self.bloomfilters[n] if len(self.bloomfilters) > n else None
-            right = other.bloomfilters[n] if len(other.bloomfilters) > n else None
-            if not left is None and not right is None:
-                self.bloomfilters[n].combine(right)
-            elif not left is None:
-                self.bloomfilters[n] = left
-            elif not right is None:
-                self.bloomfilters.append(right)
-
-        merged_entries = self.entries & other.entries
-        for entry in self.entries ^ other.entries:
-            if not any(bloom.lookup(entry[1]) for bloom in self.bloomfilters):
+        self.combine_many((other, ))
+
+    # Combines several other crdtsets in one pass. The tombstones are merged first, after that an entry survives when
+    # all states hold it or none of the tombstones has it.
+    def combine_many(self, others: Iterable["CrdtSet"]) -> None:
+        others = list(others)
+        if len(others) == 0:
+            return
+        for other in others:
+            self.tombstones, changed = combine_stores(self.tombstones, other.tombstones, self.replica_id)
+            self.Dirty |= changed
+
+        if len(others) == 1:
+            merged_entries = self.entries & others[0].entries
+            differences = self.entries ^ others[0].entries
+        else:
+            merged_entries = self.entries.intersection(*(other.entries for other in others))
+            differences = self.entries.union(*(other.entries for other in others)) - merged_entries
+        tags = [entry[1] for entry in differences]
+        stale = [other.tombstones for other in others if not self.tombstones.absorbed(other.tombstones)]
+        if len(stale) == 0:
+            removed = self.removed_tags(tags)
+        else:
+            removed = set()
+            for store in stale:
+                removed |= self.tombstones.removed_tags(tags, store)
+        for entry in differences:
+            if not entry[1] in removed:
                 merged_entries.add(entry)
 
-        self.Dirty |= (self.entries != merged_entries)
+        for entry in self.entries - merged_entries:
+            self.index_remove(entry)
+            self.record_removal(entry)
+        for entry in merged_entries - self.entries:
+            self.index_add(entry)
+            self.record_add(entry)
+
+        if self.entries != merged_entries:
+            self.Dirty = True
+            self.version += 1
         self.entries = merged_entries
+        self.promote_tombstones()
+
+    # closes the current checkpoint and returns the changes made since the previous one. The first delta taken is
+    # empty, changes are only collected from then on.
+    def take_delta(self) -> CrdtDelta:
+        self.delta_seq += 1
+        delta = CrdtDelta(self.replica_id, self.delta_seq, self.delta_entries or set(), self.delta_removals or set())
+        self.delta_entries = set()
+        self.delta_removals = set()
+        return delta
+
+    # merges a delta from an other replica. Unlike combine this only touches the entries mentioned in the delta, and
+    # because adds and removals are idempotent deltas can be applied in any order and more than once.
+    # Applied changes are recorded in our own delta as well, so they travel on to peers that don't know the origin.
+    def apply_delta(self, delta: CrdtDelta) -> None:
+        for entry in delta.removals:
+            changed = False
+            if not self.tombstones.lookup(entry[1]):
+                self.tombstones.add(entry[1])
+                changed = True
+            if entry in self.entries:
+                self.entries.remove(entry)
+                self.index_remove(entry)
+                changed = True
+            if changed:
+                self.record_removal(entry)
+                self.Dirty = True
+                self.version += 1
+        for entry in delta.entries:
+            if not entry in self.entries and not self.tombstones.lookup(entry[1]):
+                self.entries.add(entry)
+                self.index_add(entry)
+                self.record_add(entry)
+                self.Dirty = True
+                self.version += 1
+        self.promote_tombstones()
+
+    # summarises the tags of our entries, a peer subtracts its own digest to find the entries we differ in
+    def digest(self) -> InvertibleBloomFilter:
+        table = InvertibleBloomFilter()
+        table.add_many(entry[1] for entry in self.entries)
+        return table
+
+    # Works out how we differ from the replica that sent the digest, returns None when the difference is too large to
+    # decode and the full state has to be exchanged instead
+    def reconcile(self, digest: InvertibleBloomFilter) -> Union[CrdtReconciliation, None]:
+        if abs(len(digest) - len(self.entries)) > digest.cells:
+            return None
+        keys = {entry[1]: entry for entry in self.entries}
+        mine = InvertibleBloomFilter(digest.cells, digest.hashes)
+        mine.add_many(keys)
+        difference = digest.subtract(mine).decode()
+        if difference is None:
+            return None
+        theirs, ours = difference
+        removed = set()
+        wanted = set()
+        for tag in theirs:
+            if self.tombstones.lookup(tag):
+                removed.add(tag)
+            else:
+                wanted.add(tag)
+        return CrdtReconciliation({keys[key] for key in ours if key in keys}, removed, wanted)
+
+    # Merges the reconciliation a peer sent for our digest, returns the delta that completes the peer: the entries it
+    # wanted and the tombstones of the entries it sent that we already removed
+    def answer(self, reconciliation: CrdtReconciliation) -> CrdtDelta:
+        tags = reconciliation.removed | reconciliation.wanted
+        # the digest doesn't remember which entry a tag belonged to, this scan is as cheap as building it was
+        found = [entry for entry in self.entries if entry[1] in tags]
+        removals = {entry for entry in reconciliation.entries if self.tombstones.lookup(entry[1])}
+        self.apply_delta(CrdtDelta(None, 0, reconciliation.entries - removals, {entry for entry in found if entry[1] in reconciliation.removed}))
+        return CrdtDelta(self.replica_id, 0, {entry for entry in found if entry[1] in reconciliation.wanted}, removals)
+
+    def is_removed(self, tag) -> bool:
+        return self.tombstones.lookup(tag)
+
+    def reset_verdicts(self) -> None:
+        # tag -> None for removed tags, or the witness the tombstone store gave for it being live
+        self.verdicts = {}
+        self.verdicts_store = self.tombstones
+        self.verdicts_generation = self.tombstones.generation
+
+    # The same replicas get merged over and over, mostly with the same differing tags. Remember the verdicts:
+    # a removed tag stays removed until tombstones get dropped, a live tag only needs a recheck of its witness.
+    def removed_tags(self, tags: Sequence) -> set:
+        if self.verdicts_store is not self.tombstones or self.verdicts_generation != self.tombstones.generation or len(self.verdicts) > VERDICT_CACHE_LIMIT:
+            self.reset_verdicts()
+        removed = set()
+        for tag in tags:
+            if tag in self.verdicts:
+                witness = self.verdicts[tag]
+                if not witness is None:
+                    witness = self.tombstones.revalidate(tag, witness)
+            else:
+                witness = self.tombstones.live_witness(tag)
+            self.verdicts[tag] = witness
+            if witness is None:
+                removed.add(tag)
+        return removed
+
+    def promote_tombstones(self) -> None:
+        promoted = self.tombstones.promoted(self.replica_id)
+        if not promoted is None:
+            self.tombstones = promoted
+            self.Dirty = True
+
+    # the tombstone stores carry their own garbage collection state, only which replica the peer holds is learned here
+    def acknowledge(self, peer, other: "CrdtSet") -> None:
+        self.peer_replicas[peer] = other.replica_id
+
+    # Garbage collects the tombstones. members are the peers that hold a replica of this set, nothing is dropped before
+    # the replica of each of them is known and agrees.
+    def compact(self, members: Iterable) -> None:
+        replica_ids = {self.replica_id}
+        for peer in members:
+            if not peer in self.peer_replicas:
+                return
+            replica_ids.add(self.peer_replicas[peer])
+        self.Dirty |= self.tombstones.compact(replica_ids)
 
     def whitewash(self):
         pass
@@ -0,0 +1,42 @@
+from typing import Iterable, Iterator, Tuple
+
+# Small helpers to pack integers compactly for the wire.
+# Varints use the usual little endian base 128 layout, 7 bits per byte with the high bit marking continuation.
+
+def encode_varint(value: int, buffer: bytearray) -> None:
+    if value < 0:
+        raise ValueError("Can't encode negative varint %s" % value)
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def decode_varint(buffer, offset: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(buffer):
+            raise ValueError("Truncated varint")
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80 == 0:
+            return value, offset
+        shift += 7
+
+# sorted positions are stored as the varint encoded gaps between them, so dense clusters take a byte per position
+def encode_positions(positions: Iterable[int]) -> bytes:
+    buffer = bytearray()
+    previous = 0
+    for position in positions:
+        encode_varint(position - previous, buffer)
+        previous = position
+    return bytes(buffer)
+
+def decode_positions(buffer) -> Iterator[int]:
+    offset = 0
+    position = 0
+    while offset < len(buffer):
+        gap, offset = decode_varint(buffer, offset)
+        position += gap
+        yield position
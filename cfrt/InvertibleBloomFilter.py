@@ -0,0 +1,95 @@
+from typing import Iterable, List, Set, Tuple, Union
+
+# An invertible bloom lookup table over 128 bit integer keys. Like a counting bloom filter, but every cell also keeps
+# the xor of the keys and of their checksums, so after subtracting the table of an other set the few differing keys
+# can be peeled out again. Decoding succeeds with high probability while the difference stays below about
+# 2/3 of the cells, the size of the table is independent of the size of the sets.
+IBLT_CELLS = 120
+IBLT_HASHES = 3
+
+MASK_32 = (0x1 << 32) - 1
+MASK_64 = (0x1 << 64) - 1
+
+# splitmix64 finalizer over both halves of the key, so it is independent of the key bits used to pick cells
+def checksum(key: int) -> int:
+    value = (key ^ (key >> 64)) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+class InvertibleBloomFilter:
+    def __init__(self, cells=IBLT_CELLS, hashes=IBLT_HASHES) -> None:
+        self.hashes = hashes
+        # the cells are split in one partition per hash, so a key never lands in the same cell twice
+        self.cells = cells - cells % hashes
+        self.counts = [0] * self.cells
+        self.key_sums = [0] * self.cells
+        self.hash_sums = [0] * self.cells
+        # number of keys in the table, the difference of two sizes is a lower bound for the set difference
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # The keys are random tags, so plain slices of their bits are good enough to pick the cells
+    def indexes(self, key: int) -> List[int]:
+        partition = self.cells // self.hashes
+        return [i * partition + ((key >> (32 * i)) & MASK_32) % partition for i in range(0, self.hashes)]
+
+    def toggle(self, key: int, count: int) -> None:
+        key_hash = checksum(key)
+        for index in self.indexes(key):
+            self.counts[index] += count
+            self.key_sums[index] ^= key
+            self.hash_sums[index] ^= key_hash
+        self.size += count
+
+    def add(self, key: int) -> None:
+        self.toggle(key, 1)
+
+    def add_many(self, keys: Iterable[int]) -> None:
+        for key in keys:
+            self.toggle(key, 1)
+
+    def remove(self, key: int) -> None:
+        self.toggle(key, -1)
+
+    # returns the table of the keys in self but not in other (count 1) and in other but not in self (count -1)
+    def subtract(self, other: "InvertibleBloomFilter") -> "InvertibleBloomFilter":
+        if other.cells != self.cells or other.hashes != self.hashes:
+            raise ValueError("Can't subtract invertible bloom filters of different shape (%s, %s) != (%s, %s)" % (self.cells, self.hashes, other.cells, other.hashes))
+        result = InvertibleBloomFilter(self.cells, self.hashes)
+        result.counts = [mine - theirs for mine, theirs in zip(self.counts, other.counts)]
+        result.key_sums = [mine ^ theirs for mine, theirs in zip(self.key_sums, other.key_sums)]
+        result.hash_sums = [mine ^ theirs for mine, theirs in zip(self.hash_sums, other.hash_sums)]
+        result.size = self.size - other.size
+        return result
+
+    def is_pure(self, index: int) -> bool:
+        return (self.counts[index] == 1 or self.counts[index] == -1) and self.hash_sums[index] == checksum(self.key_sums[index])
+
+    # Peels the keys out of a subtracted table, returns the (positive, negative) key sets or None when the
+    # difference is too large to decode. The table is left empty when decoding succeeds.
+    # Tables come from other peers, a forged one can hold a pure looking cell that peeling never clears. Every key
+    # clears at least one cell, so no honest table peels more keys than it has cells or the same key twice.
+    def decode(self) -> Union[Tuple[Set[int], Set[int]], None]:
+        positive = set()
+        negative = set()
+        pending = [index for index in range(0, self.cells) if self.is_pure(index)]
+        while len(pending) > 0:
+            index = pending.pop()
+            if not self.is_pure(index):
+                continue
+            key = self.key_sums[index]
+            count = self.counts[index]
+            if key in positive or key in negative or len(positive) + len(negative) >= self.cells:
+                return None
+            if count > 0:
+                positive.add(key)
+            else:
+                negative.add(key)
+            self.toggle(key, -count)
+            pending.extend(other for other in self.indexes(key) if self.is_pure(other))
+        if any(self.counts) or any(self.key_sums):
+            return None
+        return positive, negative
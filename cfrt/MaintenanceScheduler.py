@@ -0,0 +1,91 @@
+from heapq import heappop, heappush
+from time import perf_counter
+from typing import Callable, List, Union
+
+# default time budget of a single slice of maintenance work, in seconds
+MAINTENANCE_SLICE_TIME = 0.01
+
+STATS_DECAY = 0.9
+STATS_DECAY_ALT = 1 - STATS_DECAY
+
+# Queues the tree nodes that need a do_check and runs those checks in slices of bounded time, so the structural work
+# doesn't hold up the event loop. Nodes are checked leaf to root: lower heights first and in order of scheduling
+# within a height. A child's check can change its entry in the parent, which the parent's check has to see after it.
+# A node is queued once, scheduling it again only moves it forward when it is given a lower height.
+class MaintenanceScheduler:
+    def __init__(self, slice_time: float = MAINTENANCE_SLICE_TIME) -> None:
+        self.slice_time = slice_time
+        # heap of (height, order, content id), entries that no longer match queued are skipped when popped
+        self.queue = []
+        # content id -> (height, node) of every queued node
+        self.queued = dict()
+        self.order = 0
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.queued)
+
+    def reset_stats(self):
+        self.stats = {
+            "queue_depth": 0,
+            "slice_count": 0,
+            "check_count": 0,
+            "last_slice_time": 0,
+            "last_slice_checks": 0,
+            "max_slice_time": 0,
+        }
+
+    def schedule(self, node, height: int) -> None:
+        queued = self.queued.get(node.content_id)
+        if not queued is None and queued[0] <= height:
+            return
+        self.order += 1
+        self.queued[node.content_id] = (height, node)
+        heappush(self.queue, (height, self.order, node.content_id))
+        self.stats["queue_depth"] = len(self.queued)
+
+    # returns the next node to check, or None when the queue is empty
+    def pop(self) -> Union[object, None]:
+        while len(self.queue) > 0:
+            height, _, content_id = heappop(self.queue)
+            queued = self.queued.get(content_id)
+            if not queued is None and queued[0] == height:
+                del self.queued[content_id]
+                return queued[1]
+        return None
+
+    # Checks queued nodes until the queue is empty or the slice took its time, returns the nodes checked. The time is
+    # only looked at between checks, a check that cascades into splits and merges still runs to its end.
+    # observe, when given, is called with every node right before it is checked.
+    def run_slice(self, slice_time: float = None, observe: Callable = None) -> List[object]:
+        if slice_time is None:
+            slice_time = self.slice_time
+        start_time = perf_counter()
+        checked = []
+        while perf_counter() - start_time < slice_time:
+            node = self.pop()
+            if node is None:
+                break
+            # a node that was checked directly in the meantime has nothing left to do
+            if not node.should_check:
+                continue
+            if not observe is None:
+                observe(node)
+            node.do_check()
+            checked.append(node)
+        self.record_slice(perf_counter() - start_time, len(checked))
+        return checked
+
+    # checks nodes until the queue is empty, including the nodes the checks themselves schedule
+    def run_all(self, observe: Callable = None) -> List[object]:
+        return self.run_slice(float("inf"), observe)
+
+    def record_slice(self, slice_time: float, checks: int) -> None:
+        self.stats["queue_depth"] = len(self.queued)
+        if checks == 0:
+            return
+        self.stats["slice_count"] += 1
+        self.stats["check_count"] += checks
+        self.stats["last_slice_checks"] = checks
+        self.stats["last_slice_time"] = STATS_DECAY * self.stats["last_slice_time"] + STATS_DECAY_ALT * slice_time
+        self.stats["max_slice_time"] = max(self.stats["max_slice_time"], slice_time)
@@ -1,46 +1,160 @@
 from random import randint
-from typing import Sequence
+from typing import Iterable, Sequence
 
+# number of compacts in a row a tombstone has to be found held by every member before it is dropped
+STABLE_ROUNDS = 5
 
+# Keeps every inserted (item, tag) entry and every tombstoned one. The live entries, Insert minus Tombstones, are kept
+# up to date on every change in Live, with Index mapping an item to its live tags, neither of them is pickled.
+# A tombstone can only be dropped, together with its insert, once every replica holds it: before that a replica that
+# still has the insert would bring the entry back. The tombstones a peer holds are learned through acknowledge, the
+# replicas are the member peers passed to compact. A dropped entry is kept in Collected until no member's state holds
+# it anymore, so the members that haven't compacted it yet don't hand it back to us.
 class NaiveORSet:
     def __init__(self) -> None:
         self.Insert = set()
         self.Tombstones = set()
+        # peer -> the tombstones of ours that it is known to have held, not pickled
+        self.Acks = dict()
+        # tombstone -> the number of compacts in a row that found every member to hold it, not pickled
+        self.Stable = dict()
+        # dropped entry -> the members whose state may still hold it, not pickled
+        self.Collected = dict()
+        self.Live = set()
+        self.Index = dict()
         self.Dirty = False
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["Acks"]
+        del state["Stable"]
+        del state["Collected"]
+        del state["Live"]
+        del state["Index"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.Acks = dict()
+        self.Stable = dict()
+        self.Collected = dict()
+        self.Live = set()
+        self.Index = dict()
+        for entry in self.Insert:
+            if not entry in self.Tombstones:
+                self.live_add(entry)
+
     def __str__(self):
-        return "entries: [" + ", ".join(["[%s, %s]" % tup for tup in self.Insert if not tup in self.Tombstones]) + "]"
+        return "entries: [" + ", ".join(["[%s, %s]" % tup for tup in self.Live]) + "]"
 
     def __len__(self):
-        return len(self._compute())
+        return len(self.Live)
 
     def __iter__(self) -> Sequence:
-        for entry in self._compute():
+        for entry in self.Live:
             yield entry[0]
 
-    def _compute(self) -> set:
-        return self.Insert.difference(self.Tombstones)
+    def live_add(self, entry) -> None:
+        self.Live.add(entry)
+        if entry[0] in self.Index:
+            self.Index[entry[0]].add(entry[1])
+        else:
+            self.Index[entry[0]] = {entry[1]}
+
+    def live_remove(self, entry) -> None:
+        self.Live.discard(entry)
+        tags = self.Index.get(entry[0])
+        if not tags is None:
+            tags.discard(entry[1])
+            if len(tags) == 0:
+                del self.Index[entry[0]]
 
     def lookup(self, item) -> bool:
-        return item in self
+        return item in self.Index
 
     def add(self, item) -> None:
         if not self.lookup(item):
             self.Dirty = True
-            self.Insert.add((item, "{0:032x}".format(randint(0, 2 ** 128))))
+            entry = (item, randint(0, 2 ** 128 - 1))
+            self.Insert.add(entry)
+            self.live_add(entry)
+
+    def add_many(self, items: Iterable) -> None:
+        for item in items:
+            self.add(item)
 
     def remove(self, item) -> None:
-        tagged_item = next((tup for tup in self.Insert if tup[0] == item and not tup in self.Tombstones), None)
-        if not tagged_item is None:
-            self.Dirty = True
-            self.Tombstones.add(tagged_item)
+        tags = self.Index.get(item)
+        if not tags is None:
+            self.tombstone((item, next(iter(tags))))
+
+    # like remove, tombstones one live tag of every item
+    def remove_many(self, items: Iterable) -> None:
+        for item in items:
+            self.remove(item)
+
+    def tombstone(self, entry) -> None:
+        self.Dirty = True
+        self.Tombstones.add(entry)
+        self.live_remove(entry)
 
     def combine(self, other: "NaiveORSet"):
-        new_insert = self.Insert.union(other.Insert)
-        new_tombstone = self.Tombstones.union(other.Tombstones)
-        self.Dirty = self.Dirty or (new_insert != self.Insert) or (new_tombstone != self.Tombstones)
-        self.Insert = new_insert
-        self.Tombstones = new_tombstone
+        self.combine_many((other, ))
+
+    # only the entries and tombstones that are new to us touch the live view
+    def combine_many(self, others: Iterable["NaiveORSet"]):
+        for other in others:
+            new_insert = other.Insert - self.Insert
+            new_tombstone = other.Tombstones - self.Tombstones
+            if len(self.Collected) > 0:
+                new_insert.difference_update(self.Collected.keys())
+                new_tombstone.difference_update(self.Collected.keys())
+            if len(new_insert) == 0 and len(new_tombstone) == 0:
+                continue
+            self.Dirty = True
+            self.Insert |= new_insert
+            self.Tombstones |= new_tombstone
+            for entry in new_insert:
+                if not entry in self.Tombstones:
+                    self.live_add(entry)
+            for entry in new_tombstone:
+                self.live_remove(entry)
+
+    # Records which of our tombstones the state a peer sent holds as well, and which dropped entries it let go of.
+    # A peer only lets go of a tombstone it held by compacting it, which it did because every member held it, so those
+    # stay acknowledged. Otherwise the first member to compact would keep everyone else from doing so.
+    def acknowledge(self, peer, other: "NaiveORSet") -> None:
+        self.Acks[peer] = (self.Tombstones & other.Tombstones) | (self.Acks.get(peer, set()) - other.Insert)
+        for entry, pending in list(self.Collected.items()):
+            if peer in pending and not entry in other.Insert:
+                pending.discard(peer)
+                if len(pending) == 0:
+                    del self.Collected[entry]
+
+    # Drops the tombstones that we and every one of the member peers hold, together with their inserts. A member that
+    # never saw a state of ours holding a tombstone can't acknowledge it once we dropped it, so a tombstone is only
+    # dropped after STABLE_ROUNDS compacts found it, each of which marks us dirty to have the state sent out again.
+    def compact(self, members: Iterable) -> None:
+        members = set(members)
+        if len(self.Tombstones) == 0 or not members.issubset(self.Acks.keys()):
+            return
+        found = self.Tombstones.intersection(*(self.Acks[peer] for peer in members))
+        self.Stable = {entry: self.Stable.get(entry, 0) + 1 for entry in found}
+        stable = {entry for entry, rounds in self.Stable.items() if rounds >= STABLE_ROUNDS}
+        for entry in stable:
+            del self.Stable[entry]
+        if len(self.Stable) > 0:
+            self.Dirty = True
+        if len(stable) == 0:
+            return
+        self.Tombstones -= stable
+        self.Insert -= stable
+        for acked in self.Acks.values():
+            acked -= stable
+        if len(members) > 0:
+            for entry in stable:
+                self.Collected[entry] = set(members)
+        self.Dirty = True
 
     def whitewash(self):
-        pass
\ No newline at end of file
+        pass
@@ -1,27 +1,93 @@
+from bisect import bisect_right
+from heapq import merge
 from random import randint
-from typing import Sequence
+from typing import Iterable, List, Sequence, Tuple
 
+# number of compacts in a row a retired id has to be found done with by every member before it is dropped
+STABLE_ROUNDS = 5
+
+# The version vector maps a replica id to the clock values seen from it, as a sorted list of disjoint (l, r)
+# intervals that don't touch either, (1, 3) and (4, 6) are always stored as (1, 6).
 
 def IsInIntervalVector(vector, replica_id, timestamp):
-    if replica_id in vector:
-        for l, r in vector[replica_id]:
-            if l <= timestamp <= r:
-                return True
-    return False
-
-def CollapseVector(vector):
-    for i in range(len(vector) - 1, 0, -1):
-        if vector[i-1][1] >= vector[i][0] - 1:
-            vector[i-1] = (min(vector[i-1][0], vector[i][0]), max(vector[i-1][1], vector[i][1]))
-            del vector[i]
+    intervals = vector.get(replica_id)
+    if not intervals:
+        return False
+    # the last interval starting at or before timestamp is the only one that can contain it
+    i = bisect_right(intervals, (timestamp, float("inf"))) - 1
+    return i >= 0 and timestamp <= intervals[i][1]
+
+# merges any number of interval lists in one linear pass
+def MergeIntervals(*vectors) -> List[Tuple[int, int]]:
+    result = []
+    for l, r in merge(*vectors):
+        if len(result) > 0 and l <= result[-1][1] + 1:
+            if r > result[-1][1]:
+                result[-1] = (result[-1][0], r)
+        else:
+            result.append((l, r))
+    return result
+
+# whether the vector holds every clock value from first up to and including last
+def CoversRange(vector, replica_id, first, last):
+    intervals = vector.get(replica_id)
+    if not intervals:
+        return False
+    i = bisect_right(intervals, (first, float("inf"))) - 1
+    return i >= 0 and intervals[i][1] >= last
+
+# adds an interval to a list, the local clock only moves forward so this nearly always extends or follows the last one
+def AppendInterval(vector, first, last):
+    if len(vector) == 0 or first > vector[-1][1] + 1:
+        vector.append((first, last))
+    elif first >= vector[-1][0]:
+        vector[-1] = (vector[-1][0], max(last, vector[-1][1]))
+    else:
+        vector[:] = MergeIntervals(vector, [(first, last)])
 
+# Every whitewash leaves the old id behind in the vector. Its final clock is recorded in Retired, no dots are minted
+# under it anymore. Once every replica has seen all of its dots and none of them holds an entry with it, nobody can
+# tell a removal of such an entry from not having seen it, because there are none, and the id is dropped from Vector.
+# Which peers are in that position is learned through acknowledge, for every state a peer sends us, and an id is only
+# dropped when that holds for every member: the peers known to hold a replica, passed to compact. A dropped id is kept
+# in Collected until no member's state has it anymore, so the members that haven't dropped it yet don't hand it back.
 class OptORSet:
     def __init__(self) -> None:
         self.Entries = set()
         self.Vector = dict()
+        # retired id -> the last clock value used under it
+        self.Retired = dict()
+        # retired id -> peers whose last state saw all of its dots and holds none of its entries, not pickled
+        self.Acks = dict()
+        # retired id -> the number of compacts in a row that found every member done with it, not pickled
+        self.Stable = dict()
+        # dropped id -> the members whose state may still have it, not pickled
+        self.Collected = dict()
+        # element -> the (id, clock) dots of that element in Entries, derived state that is not pickled
+        self.Index = dict()
         self.Dirty = False
+        self.Id = None
+        self.Clock = 0
         self.whitewash()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["Index"]
+        del state["Acks"]
+        del state["Stable"]
+        del state["Collected"]
+        return state
+
+    def __setstate__(self, state):
+        self.Retired = dict()
+        self.__dict__.update(state)
+        self.Acks = dict()
+        self.Stable = dict()
+        self.Collected = dict()
+        self.Index = dict()
+        for m in self.Entries:
+            self.index_add(m)
+
     def __str__(self):
         return "entries: [" + ", ".join(item[0] for item in self.Entries) + "], version vect: %r" % self.Vector
 
@@ -33,57 +99,148 @@ class OptORSet:
             yield entry[0]
 
     def lookup(self, item) -> bool:
-        for m in self.Entries:
-            if m[0] == item:
-                return True
-        return False
+        return item in self.Index
+
+    def index_add(self, m) -> None:
+        if m[0] in self.Index:
+            self.Index[m[0]].add((m[1], m[2]))
+        else:
+            self.Index[m[0]] = {(m[1], m[2])}
+
+    def index_remove(self, m) -> None:
+        dots = self.Index[m[0]]
+        dots.discard((m[1], m[2]))
+        if len(dots) == 0:
+            del self.Index[m[0]]
 
     def add(self, item) -> None:
         self.Clock += 1
         self.Entries.add((item, self.Id, self.Clock))
+        self.index_add((item, self.Id, self.Clock))
+        self.observe(self.Clock, self.Clock)
+        self.Dirty = True
+
+    # adds all items under one contiguous range of clock values, so the vector only gets a single interval
+    def add_many(self, items: Iterable) -> None:
+        first = self.Clock + 1
+        for item in items:
+            self.Clock += 1
+            self.Entries.add((item, self.Id, self.Clock))
+            self.index_add((item, self.Id, self.Clock))
+        if self.Clock < first:
+            return
+        self.observe(first, self.Clock)
+        self.Dirty = True
+
+    # records that this replica used the clock values first up to and including last
+    def observe(self, first: int, last: int) -> None:
         if not self.Id in self.Vector:
             self.Vector[self.Id] = list()
-        vect = self.Vector[self.Id]
-        vect.append((self.Clock, self.Clock))
-        vect.sort(key=lambda k: k[0])
-        CollapseVector(vect)
-        self.Dirty = True
+        AppendInterval(self.Vector[self.Id], first, last)
 
     def remove(self, item) -> None:
-        removed = False
-        for m in list(self.Entries):
-            if m[0] == item:
-                self.Entries.remove(m)
-                removed = True
-        if removed:
-            self.Clock += 1
-            if not self.Id in self.Vector:
-                self.Vector[self.Id] = list()
-            vect = self.Vector[self.Id]
-            vect.append((self.Clock, self.Clock))
-            vect.sort(key=lambda k: k[0])
-            CollapseVector(vect)
-            self.Dirty = True
+        self.remove_many((item, ))
+
+    # removes all items at once, the removal takes a single clock value
+    def remove_many(self, items: Iterable) -> None:
+        removed = []
+        for item in items:
+            dots = self.Index.pop(item, None)
+            if not dots is None:
+                removed.extend((item, replica_id, clock) for replica_id, clock in dots)
+        if len(removed) == 0:
+            return
+        self.Entries.difference_update(removed)
+        self.Clock += 1
+        self.observe(self.Clock, self.Clock)
+        self.Dirty = True
 
     def combine(self, other: "OptORSet"):
-        newEntries = self.Entries.intersection(other.Entries)
-        for m in self.Entries ^ other.Entries:
-            if IsInIntervalVector(self.Vector, m[1], m[2]) and IsInIntervalVector(other.Vector, m[1], m[2]):
+        self.combine_many((other, ))
+
+    # Combines several other OptORSets in one pass. An entry is dropped when a state has seen its dot, but no longer
+    # holds it. An entry every state holds is kept without checking.
+    def combine_many(self, others: Iterable["OptORSet"]):
+        others = list(others)
+        if len(self.Collected) > 0:
+            others = [other.without_ids(self.Collected.keys()) for other in others]
+        states = [self] + others
+        newEntries = self.Entries.intersection(*(state.Entries for state in states[1:]))
+        for m in set().union(*(state.Entries for state in states)) - newEntries:
+            if any(not m in state.Entries and IsInIntervalVector(state.Vector, m[1], m[2]) for state in states):
                 continue
             else:
                 newEntries.add(m)
+        for m in self.Entries - newEntries:
+            self.index_remove(m)
+        for m in newEntries - self.Entries:
+            self.index_add(m)
         self.Dirty = self.Dirty or newEntries != self.Entries
         self.Entries = newEntries
-        for key in set(self.Vector.keys()).union(other.Vector.keys()):
-            if not key in self.Vector:
-                self.Vector[key] = list()
-            if not key in other.Vector:
-                otherV = list()
-            else:
-                otherV = list(other.Vector[key])
-            self.Vector[key] += otherV
-            CollapseVector(self.Vector[key])
+        for key in set().union(*(state.Vector.keys() for state in states[1:])):
+            self.Vector[key] = MergeIntervals(*(state.Vector[key] for state in states if key in state.Vector))
+        for state in states[1:]:
+            for replica_id, clock in state.Retired.items():
+                self.Retired[replica_id] = max(clock, self.Retired.get(replica_id, 0))
+
+    # returns a copy of the state without the entries, clocks and retirements of the given ids
+    def without_ids(self, ids) -> "OptORSet":
+        if not any(replica_id in self.Vector or replica_id in self.Retired for replica_id in ids):
+            return self
+        state = OptORSet.__new__(OptORSet)
+        state.Entries = {m for m in self.Entries if not m[1] in ids}
+        state.Vector = {replica_id: intervals for replica_id, intervals in self.Vector.items() if not replica_id in ids}
+        state.Retired = {replica_id: clock for replica_id, clock in self.Retired.items() if not replica_id in ids}
+        return state
+
+    # Records whether the state a peer sent lets retired ids go, and which dropped ids it let go of. A peer that was
+    # done with an id only loses it by dropping it, which it did because every member was done with it, so an id
+    # the state doesn't have at all stays acknowledged. Otherwise the first member to drop it would keep the others
+    # from doing so.
+    def acknowledge(self, peer, other: "OptORSet") -> None:
+        if len(self.Retired) == 0 and len(self.Collected) == 0:
+            return
+        held = set(m[1] for m in other.Entries)
+        for replica_id, clock in self.Retired.items():
+            if not replica_id in held and CoversRange(other.Vector, replica_id, 1, clock):
+                self.Acks.setdefault(replica_id, set()).add(peer)
+            elif replica_id in self.Acks and (replica_id in held or replica_id in other.Vector or replica_id in other.Retired):
+                self.Acks[replica_id].discard(peer)
+        for replica_id, pending in list(self.Collected.items()):
+            if peer in pending and not replica_id in other.Vector and not replica_id in other.Retired:
+                pending.discard(peer)
+                if len(pending) == 0:
+                    del self.Collected[replica_id]
+
+    # Drops the retired ids that we and every one of the member peers are done with. A member that never saw a state of
+    # ours that is done with an id can't acknowledge it once we dropped it, so an id is only dropped after
+    # STABLE_ROUNDS compacts found it, each of which marks us dirty to have the state sent out again.
+    def compact(self, members: Iterable) -> None:
+        members = set(members)
+        held = None
+        stable = dict()
+        for replica_id, clock in self.Retired.items():
+            if not self.Acks.get(replica_id, set()).issuperset(members):
+                continue
+            if held is None:
+                held = set(m[1] for m in self.Entries)
+            if not replica_id in held and CoversRange(self.Vector, replica_id, 1, clock):
+                stable[replica_id] = self.Stable.get(replica_id, 0) + 1
+        self.Stable = stable
+        for replica_id, rounds in list(stable.items()):
+            if rounds < STABLE_ROUNDS:
+                continue
+            self.Vector.pop(replica_id, None)
+            del self.Retired[replica_id]
+            del self.Stable[replica_id]
+            self.Acks.pop(replica_id, None)
+            if len(members) > 0:
+                self.Collected[replica_id] = set(members)
+        if len(stable) > 0:
+            self.Dirty = True
 
     def whitewash(self):
+        if not self.Id is None and self.Clock > 0:
+            self.Retired[self.Id] = self.Clock
         self.Id = "%s" % randint(0, 2 ** 256)
         self.Clock = 0
\ No newline at end of file
@@ -0,0 +1,457 @@
+from array import array
+from copy import deepcopy
+from hashlib import md5
+from random import randint
+from typing import Iterable, Sequence, Tuple, Union
+
+from experiments.cfrt.thesis.BloomFilter import BloomFilter, DEFAULT_HASH_FAMILY, item_bytes
+
+# A tombstone store keeps the tags that have been removed from a CrdtSet. Stores only ever grow through add and
+# combine, a tag that has been found once stays found until compact decides no replica can hold it anymore.
+#
+# Three stores are available
+#  - "exact": the plain set of removed tags, smallest for nodes that see few removals
+#  - "bloom": a chain of bloomfilters that is garbage collected by epoch, see BloomChainStore
+#  - "cuckoo": a chain of cuckoo filters, more compact than bloomfilters at low false positive rates
+# and "auto", which starts out exact and switches to AUTO_PROMOTE_KIND once it holds more than AUTO_EXACT_LIMIT tags.
+#
+# An exact store can be merged into any other one, but bloom and cuckoo chains can't be turned into each other as
+# neither keeps the tags. The kind is therefore a setting of the whole community, see set_default_tombstones, a state
+# whose chain is of the other kind can't be combined and is dropped.
+
+class TombstoneStore:
+    kind = None
+    # Stores count their changes so lookups can be cached. version goes up whenever tombstones may have been added,
+    # generation whenever tombstones may have been dropped.
+    version = 0
+    generation = 0
+
+    def __len__(self) -> int:
+        raise NotImplementedError()
+
+    def add(self, tag) -> None:
+        raise NotImplementedError()
+
+    def add_many(self, tags: Sequence) -> None:
+        for tag in tags:
+            self.add(tag)
+
+    def lookup(self, tag) -> bool:
+        raise NotImplementedError()
+
+    # returns the subset of tags that is removed according to this store. Other is the store that was just combined
+    # into this one, in case it contained tombstones this store did not take over.
+    def removed_tags(self, tags: Sequence, other: "TombstoneStore" = None) -> set:
+        return set(tag for tag in tags if self.lookup(tag))
+
+    # returns None if tag is removed, otherwise a witness of it being live that revalidate can check
+    def live_witness(self, tag):
+        return None if self.lookup(tag) else self.version
+
+    # checks a witness from live_witness against the current state, returns None if tag has been removed since,
+    # or a (new) witness if it is still live
+    def revalidate(self, tag, witness):
+        if witness == self.version:
+            return witness
+        return self.live_witness(tag)
+
+    # merges another store of the same kind into this one, returns whether anything beyond tombstones changed
+    def combine(self, other: "TombstoneStore") -> bool:
+        raise NotImplementedError()
+
+    # whether the last combine took over all tombstones of other
+    def absorbed(self, other: "TombstoneStore") -> bool:
+        return True
+
+    # garbage collects tombstones that the replicas with the given ids, every replica that exists, all agree upon.
+    # Returns whether anything changed
+    def compact(self, replica_ids: Iterable[int]) -> bool:
+        return False
+
+    # returns the store that should replace this one, or None if it is fine as it is
+    def promoted(self, replica_id: int) -> Union["TombstoneStore", None]:
+        return None
+
+    def empty_copy(self, replica_id: int) -> "TombstoneStore":
+        raise NotImplementedError()
+
+
+class ExactTagStore(TombstoneStore):
+    kind = "exact"
+
+    def __init__(self, limit: Union[int, None] = None, promote_to: str = None, hash_family=DEFAULT_HASH_FAMILY) -> None:
+        self.tags = set()
+        self.limit = limit
+        self.promote_to = promote_to
+        self.hash_family = hash_family
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def add(self, tag) -> None:
+        if not tag in self.tags:
+            self.tags.add(tag)
+            self.version += 1
+
+    def add_many(self, tags: Sequence) -> None:
+        if not self.tags.issuperset(tags):
+            self.tags.update(tags)
+            self.version += 1
+
+    def lookup(self, tag) -> bool:
+        return tag in self.tags
+
+    def removed_tags(self, tags: Sequence, other: TombstoneStore = None) -> set:
+        return self.tags.intersection(tags)
+
+    def combine(self, other: "ExactTagStore") -> bool:
+        if not self.tags.issuperset(other.tags):
+            self.tags |= other.tags
+            self.version += 1
+        return False
+
+    def promoted(self, replica_id: int) -> Union[TombstoneStore, None]:
+        if self.limit is None or len(self.tags) <= self.limit:
+            return None
+        store = create_store(self.promote_to, replica_id, self.hash_family)
+        store.add_many(self.tags)
+        return store
+
+    def empty_copy(self, replica_id: int) -> "ExactTagStore":
+        return ExactTagStore(self.limit, self.promote_to, self.hash_family)
+
+
+# Bloomfilters are numbered by epoch, the epoch of a filter is its position in the chain as if nothing was ever
+# dropped. A replica writes tombstones into its last (active) filter only, so once every replica moved its active
+# filter past an epoch, and every replica has learned that, nobody can still hold an entry that is tombstoned in
+# that epoch and its filter can be retired.
+#
+# A chain created here starts at epoch 0 without knowing which epochs the others are at, they may have retired the
+# filters it writes into already. Until it is first combined with another chain it keeps the tags it was given in
+# unsynced, to write them again into the active filter once the combine moved it to the others' epochs.
+class BloomChainStore(TombstoneStore):
+    kind = "bloom"
+    # None once the chain has been combined with another one, as is any chain that was received
+    unsynced = None
+
+    def __init__(self, replica_id: int, hash_family=DEFAULT_HASH_FAMILY) -> None:
+        self.replica_id = replica_id
+        self.bloomfilters = [ BloomFilter(hash_family=hash_family) ]
+        self.bloom_slack = 550
+        # epoch of bloomfilters[0], everything before it has been retired
+        self.base_epoch = 0
+        # per replica, the epoch of the filter it is writing tombstones into
+        self.active_epochs = {replica_id: 0}
+        # per replica, the highest epoch it knows to be sealed by all replicas
+        self.stable_epochs = {}
+        self.unsynced = set()
+
+    def __len__(self) -> int:
+        return int(sum(bloom.estimated_size for bloom in self.bloomfilters))
+
+    @property
+    def active_epoch(self) -> int:
+        return self.base_epoch + len(self.bloomfilters) - 1
+
+    def add(self, tag) -> None:
+        #print("Bloomfilter estimated size %s, max elements %s, bloom slack %s" %(self.bloomfilters[-1].estimated_size, self.bloomfilters[-1].max_elements, self.bloom_slack))
+        if self.bloomfilters[-1].estimated_size >= self.bloomfilters[-1].max_elements - self.bloom_slack:
+            self.bloomfilters.append(BloomFilter(max_elements=self.bloomfilters[-1].max_elements*2, hash_family=self.bloomfilters[-1].hash_family))
+            self.active_epochs[self.replica_id] = self.active_epoch
+        self.bloomfilters[-1].add(tag)
+        self.version += 1
+        if not self.unsynced is None:
+            self.unsynced.add(tag)
+
+    # fills the active filter up to the same point add would, then continues in a new one
+    def add_many(self, tags: Sequence) -> None:
+        tags = list(tags)
+        if not self.unsynced is None:
+            self.unsynced.update(tags)
+        while len(tags) > 0:
+            bloom = self.bloomfilters[-1]
+            room = int(bloom.max_elements - self.bloom_slack - bloom.estimated_size)
+            if room <= 0:
+                self.bloomfilters.append(BloomFilter(max_elements=bloom.max_elements*2, hash_family=bloom.hash_family))
+                self.active_epochs[self.replica_id] = self.active_epoch
+                continue
+            bloom.add_many(tags[:room])
+            del tags[:room]
+            self.version += 1
+
+    # checks a tag against all bloomfilters, hashing it only once per hash family in the chain
+    def lookup(self, tag) -> bool:
+        hashes = {}
+        for bloom in self.bloomfilters:
+            if not bloom.hash_family in hashes:
+                hashes[bloom.hash_family] = bloom.hashes_for(tag)
+            if bloom.lookup_hashes(hashes[bloom.hash_family]):
+                return True
+        return False
+
+    # the witness holds, for every filter in the chain, the epoch and the index of a bit not set for tag. As long as
+    # those bits stay unset tag is live without having to hash it again.
+    def live_witness(self, tag):
+        return self.revalidate(tag, ())
+
+    def revalidate(self, tag, witness):
+        known = dict(witness)
+        result = []
+        hashes = {}
+        for n, bloom in enumerate(self.bloomfilters):
+            epoch = self.base_epoch + n
+            index = known.get(epoch)
+            if index is None or bloom.get_bit(index):
+                if not bloom.hash_family in hashes:
+                    hashes[bloom.hash_family] = bloom.hashes_for(tag)
+                index = bloom.first_unset(hashes[bloom.hash_family])
+                if index is None:
+                    return None
+            result.append((epoch, index))
+        return tuple(result)
+
+    # tests all tags against one bloomfilter at a time so array backed filters can vectorize
+    def removed_tags(self, tags: Sequence, other: TombstoneStore = None) -> set:
+        bloomfilters = self.bloomfilters
+        if isinstance(other, BloomChainStore):
+            # a stale state may still carry filters we already retired, its entries need checking against those as well
+            bloomfilters = [bloom for n, bloom in enumerate(other.bloomfilters) if other.base_epoch + n < self.base_epoch] + bloomfilters
+
+        removed = set()
+        pending = list(tags)
+        family = None
+        hashes = []
+        for bloom in bloomfilters:
+            if len(pending) == 0:
+                break
+            if bloom.hash_family != family:
+                family = bloom.hash_family
+                hashes = [bloom.hashes_for(tag) for tag in pending]
+            still_pending = []
+            still_hashes = []
+            for tag, tag_hashes, found in zip(pending, hashes, bloom.lookup_hashes_many(hashes)):
+                if found:
+                    removed.add(tag)
+                else:
+                    still_pending.append(tag)
+                    still_hashes.append(tag_hashes)
+            pending = still_pending
+            hashes = still_hashes
+        return removed
+
+    # Raises ValueError, before changing anything, when a filter of other doesn't have the shape of ours for that epoch
+    def combine(self, other: "BloomChainStore") -> bool:
+        for n, bloom in enumerate(other.bloomfilters):
+            position = other.base_epoch + n - self.base_epoch
+            if 0 <= position < len(self.bloomfilters):
+                mine = self.bloomfilters[position]
+                if mine.m != bloom.m or mine.hash_family != bloom.hash_family:
+                    raise ValueError("Can't combine bloom filter chains, epoch %s has shape (%s, %s) != (%s, %s)" % (self.base_epoch + position, mine.m, mine.hash_family, bloom.m, bloom.hash_family))
+        changed = False
+        if other.base_epoch > self.base_epoch:
+            changed |= self.retire(other.base_epoch - 1)
+        for n, bloom in enumerate(other.bloomfilters):
+            position = other.base_epoch + n - self.base_epoch
+            if position < 0:
+                continue
+            if position < len(self.bloomfilters):
+                if self.bloomfilters[position].combine(bloom):
+                    self.version += 1
+            else:
+                self.bloomfilters.append(deepcopy(bloom))
+                self.version += 1
+
+        changed |= self.merge_epochs(self.active_epochs, other.active_epochs)
+        changed |= self.merge_epochs(self.stable_epochs, other.stable_epochs)
+        changed |= self.merge_epochs(self.active_epochs, {self.replica_id: self.active_epoch})
+        if not self.unsynced is None:
+            unsynced = self.unsynced
+            self.unsynced = None
+            if self.base_epoch > 0:
+                self.add_many(unsynced)
+        return changed
+
+    @staticmethod
+    def merge_epochs(mine: dict, theirs: dict) -> bool:
+        changed = False
+        for replica_id, epoch in theirs.items():
+            if mine.get(replica_id, -1) < epoch:
+                mine[replica_id] = epoch
+                changed = True
+        return changed
+
+    # drops all bloomfilters up to and including epoch
+    def retire(self, epoch: int) -> bool:
+        if epoch < self.base_epoch:
+            return False
+        del self.bloomfilters[:epoch + 1 - self.base_epoch]
+        self.base_epoch = epoch + 1
+        self.generation += 1
+        return True
+
+    def absorbed(self, other: TombstoneStore) -> bool:
+        return not isinstance(other, BloomChainStore) or other.base_epoch >= self.base_epoch
+
+    # Only the epochs of the given replicas count, and all of them have to be known: a member we haven't heard from may
+    # still write into, or hold entries tombstoned in, any epoch. Replicas outside the set don't hold anything back.
+    def compact(self, replica_ids: Iterable[int]) -> bool:
+        changed = False
+        active = [self.active_epochs.get(replica_id) for replica_id in replica_ids]
+        if len(active) > 0 and not None in active:
+            stable = min(active) - 1
+            if stable > self.stable_epochs.get(self.replica_id, -1):
+                self.stable_epochs[self.replica_id] = stable
+                changed = True
+        stable = [self.stable_epochs.get(replica_id) for replica_id in replica_ids]
+        if len(stable) > 0 and not None in stable:
+            changed |= self.retire(min(stable))
+        return changed
+
+    def empty_copy(self, replica_id: int) -> "BloomChainStore":
+        return BloomChainStore(replica_id, self.bloomfilters[0].hash_family)
+
+
+CUCKOO_BUCKETS = 64
+CUCKOO_BUCKET_SIZE = 4
+CUCKOO_MAX_KICKS = 500
+
+# Cuckoo filter with 32 bit fingerprints and 4 slots per bucket, an empty slot holds 0.
+# Every filter in a chain has the same number of buckets (a power of two), so a fingerprint can be moved between
+# filters and replicas knowing only its bucket.
+class CuckooFilter:
+    def __init__(self, buckets: int = CUCKOO_BUCKETS) -> None:
+        self.buckets = buckets
+        self.slots = array("I", [0] * (buckets * CUCKOO_BUCKET_SIZE))
+
+    def __len__(self) -> int:
+        return sum(1 for fingerprint in self.slots if fingerprint != 0)
+
+    @staticmethod
+    def locate(tag) -> Tuple[int, int]:
+        digest = md5(item_bytes(tag)).digest()
+        return int.from_bytes(digest[:4], "little"), int.from_bytes(digest[4:8], "little") or 1
+
+    def alternate(self, index: int, fingerprint: int) -> int:
+        return (index ^ (fingerprint * 0x5bd1e995)) & (self.buckets - 1)
+
+    def bucket(self, index: int) -> Sequence[int]:
+        return self.slots[index * CUCKOO_BUCKET_SIZE:(index + 1) * CUCKOO_BUCKET_SIZE]
+
+    def contains(self, index: int, fingerprint: int) -> bool:
+        index &= self.buckets - 1
+        return fingerprint in self.bucket(index) or fingerprint in self.bucket(self.alternate(index, fingerprint))
+
+    def put(self, index: int, fingerprint: int) -> bool:
+        for slot in range(index * CUCKOO_BUCKET_SIZE, (index + 1) * CUCKOO_BUCKET_SIZE):
+            if self.slots[slot] == 0:
+                self.slots[slot] = fingerprint
+                return True
+        return False
+
+    # inserts a fingerprint, returns the (index, fingerprint) that got kicked out for good when the filter is full
+    def insert(self, index: int, fingerprint: int) -> Union[None, Tuple[int, int]]:
+        index &= self.buckets - 1
+        if self.put(index, fingerprint) or self.put(self.alternate(index, fingerprint), fingerprint):
+            return None
+        for _ in range(0, CUCKOO_MAX_KICKS):
+            slot = index * CUCKOO_BUCKET_SIZE + randint(0, CUCKOO_BUCKET_SIZE - 1)
+            fingerprint, self.slots[slot] = self.slots[slot], fingerprint
+            index = self.alternate(index, fingerprint)
+            if self.put(index, fingerprint):
+                return None
+        return index, fingerprint
+
+    def fingerprints(self) -> Iterable[Tuple[int, int]]:
+        for slot, fingerprint in enumerate(self.slots):
+            if fingerprint != 0:
+                yield slot // CUCKOO_BUCKET_SIZE, fingerprint
+
+
+class CuckooChainStore(TombstoneStore):
+    kind = "cuckoo"
+
+    def __init__(self, replica_id: int = None, hash_family=None) -> None:
+        self.filters = [ CuckooFilter() ]
+
+    def __len__(self) -> int:
+        return sum(len(cuckoo) for cuckoo in self.filters)
+
+    def contains(self, index: int, fingerprint: int) -> bool:
+        return any(cuckoo.contains(index, fingerprint) for cuckoo in self.filters)
+
+    def insert(self, index: int, fingerprint: int) -> None:
+        if self.contains(index, fingerprint):
+            return
+        self.version += 1
+        # only the last filter has room, a new one is appended when it overflows
+        homeless = self.filters[-1].insert(index, fingerprint)
+        if not homeless is None:
+            self.filters.append(CuckooFilter(self.filters[0].buckets))
+            self.filters[-1].insert(*homeless)
+
+    def add(self, tag) -> None:
+        self.insert(*CuckooFilter.locate(tag))
+
+    def lookup(self, tag) -> bool:
+        return self.contains(*CuckooFilter.locate(tag))
+
+    def combine(self, other: "CuckooChainStore") -> bool:
+        for cuckoo in other.filters:
+            for index, fingerprint in cuckoo.fingerprints():
+                self.insert(index, fingerprint)
+        return False
+
+    def empty_copy(self, replica_id: int) -> "CuckooChainStore":
+        return CuckooChainStore(replica_id)
+
+
+TOMBSTONE_STORES = {
+    ExactTagStore.kind: ExactTagStore,
+    BloomChainStore.kind: BloomChainStore,
+    CuckooChainStore.kind: CuckooChainStore,
+}
+
+AUTO = "auto"
+AUTO_EXACT_LIMIT = 128
+AUTO_PROMOTE_KIND = BloomChainStore.kind
+DEFAULT_TOMBSTONES = AUTO
+
+# Sets the kind of store new replicas start out with, and the kind an "auto" store switches to. Every peer of a community
+# has to use the same kinds.
+def set_default_tombstones(kind: str, promote_to: str = None) -> None:
+    global DEFAULT_TOMBSTONES, AUTO_PROMOTE_KIND
+    if kind != AUTO and not kind in TOMBSTONE_STORES:
+        raise ValueError("Unknown tombstone store %r" % kind)
+    if not promote_to is None:
+        if promote_to == ExactTagStore.kind or not promote_to in TOMBSTONE_STORES:
+            raise ValueError("Can't promote tombstones to %r" % promote_to)
+        AUTO_PROMOTE_KIND = promote_to
+    DEFAULT_TOMBSTONES = kind
+
+def create_store(kind: Union[str, None], replica_id: int, hash_family=DEFAULT_HASH_FAMILY) -> TombstoneStore:
+    if kind is None:
+        kind = DEFAULT_TOMBSTONES
+    if kind == AUTO:
+        return ExactTagStore(AUTO_EXACT_LIMIT, AUTO_PROMOTE_KIND, hash_family)
+    if kind == ExactTagStore.kind:
+        return ExactTagStore(hash_family=hash_family)
+    if not kind in TOMBSTONE_STORES:
+        raise ValueError("Unknown tombstone store %r" % kind)
+    return TOMBSTONE_STORES[kind](replica_id, hash_family)
+
+# merges theirs into mine and returns the resulting store, which is a new one in case mine had to change kind
+def combine_stores(mine: TombstoneStore, theirs: TombstoneStore, replica_id: int) -> Tuple[TombstoneStore, bool]:
+    if type(mine) is type(theirs):
+        return mine, mine.combine(theirs)
+    if isinstance(theirs, ExactTagStore):
+        for tag in theirs.tags:
+            mine.add(tag)
+        return mine, False
+    if isinstance(mine, ExactTagStore):
+        # take over their epochs first, so our tags end up in the active filter rather than in one they retired
+        store = theirs.empty_copy(replica_id)
+        store.combine(theirs)
+        store.add_many(mine.tags)
+        return store, True
+    # neither chain keeps its tags, so there is nothing to convert, the peers don't share the same tombstone setting
+    raise ValueError("Can't combine %s tombstones with %s tombstones, every peer has to use the same kind" % (mine.kind, theirs.kind))
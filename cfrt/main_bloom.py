@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+# CrdtSet builds its filters from the package module, DEFAULT_STORAGE has to be patched on that one rather than on a
+# second copy imported from this directory
+from experiments.cfrt.thesis.CrdtSet import CrdtSet
+import experiments.cfrt.thesis.BloomFilter as BloomFilter
+from random import shuffle
+import pickle
+import timeit
+
+# Measures CrdtSet.combine throughput for each bloom filter hash family and bit storage. "md5-iterated" is the
+# original one-digest-per-index scheme, the others derive all indexes from a single digest.
+ELEMENTS = 2000
+REMOVED = 600
+RUNS = 10
+
+all_items = [str(x) for x in range(0, ELEMENTS)]
+
+def build(family):
+    left = CrdtSet(hash_family=family, tombstones="bloom")
+    right = CrdtSet(hash_family=family, tombstones="bloom")
+    shuffle(all_items)
+    for item in all_items:
+        left.add(item)
+    right.combine(left)
+    for item in all_items[:REMOVED]:
+        left.remove(item)
+    for item in all_items[REMOVED:2 * REMOVED]:
+        right.remove(item)
+        right.add(item)
+    return left, right
+
+storages = [BloomFilter.STORAGE_BYTEARRAY]
+if not BloomFilter.numpy is None:
+    storages.append(BloomFilter.STORAGE_NUMPY)
+
+print("Family; Storage; Elements; Differing tags; Combine time; Combines per second; Repeated combine time; Lookups per second; Filter combine time")
+for storage in storages:
+    BloomFilter.DEFAULT_STORAGE = storage
+    for family in BloomFilter.HASH_FAMILIES.keys():
+        left, right = build(family)
+        differing = len(left.entries ^ right.entries)
+        buffer = pickle.dumps(left)
+        time_combine = min(timeit.repeat(lambda: pickle.loads(buffer).combine(right), repeat=RUNS, number=1))
+        time_unpickle = min(timeit.repeat(lambda: pickle.loads(buffer), repeat=RUNS, number=1))
+        time_combine -= time_unpickle
+
+        # merging the same replica again only revalidates the remembered verdicts
+        target = pickle.loads(buffer)
+        target.combine(right)
+        time_repeat = min(timeit.repeat(lambda: target.combine(right), repeat=RUNS, number=1))
+
+        tags = [entry[1] for entry in right.entries]
+        time_lookup = min(timeit.repeat(lambda: left.tombstones.bloomfilters[0].lookup_many(tags), repeat=RUNS, number=1))
+        time_filter = min(timeit.repeat(lambda: left.tombstones.bloomfilters[0].combine(right.tombstones.bloomfilters[0]), repeat=RUNS, number=1))
+        print("%s;%s;%s;%s;%s;%s;%s;%s;%s" % (family, storage, ELEMENTS, differing, time_combine, 1 / time_combine, time_repeat, len(tags) / time_lookup, time_filter))
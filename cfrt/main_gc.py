@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+# the codec only knows the package classes, so import through the package rather than from this directory
+from experiments.cfrt.thesis.NaiveORSet import NaiveORSet
+from experiments.cfrt.thesis.OptOrSet import OptORSet
+import experiments.cfrt.thesis.Codec as Codec
+from random import choice, random, seed
+
+# Shows the garbage collection of the OR-sets at work. A few replicas add, remove and whitewash, and every round each
+# one compacts and sends its state to all others, like the community does on a broadcast. Without members nothing is
+# ever collected, with members the tombstones and retired ids that every replica holds get dropped. Retired ids that
+# still have live entries stay.
+REPLICAS = 4
+ROUNDS = 40
+# rounds with changes, the remaining rounds only exchange state
+ACTIVE_ROUNDS = 20
+CHANGES = 20
+WHITEWASH_PROBABILITY = 0.3
+
+def garbage(replica) -> int:
+    if isinstance(replica, NaiveORSet):
+        return len(replica.Tombstones)
+    return len(replica.Retired)
+
+def run(kind, use_members):
+    seed(42)
+    peers = [b"peer%d" % i for i in range(0, REPLICAS)]
+    replicas = {peer: kind() for peer in peers}
+    counter = 0
+    for round in range(0, ROUNDS):
+        for peer, replica in replicas.items():
+            if round < ACTIVE_ROUNDS:
+                for i in range(0, CHANGES):
+                    if len(replica) > 0 and random() < 0.5:
+                        replica.remove(choice(list(replica)))
+                    else:
+                        counter += 1
+                        replica.add("%s" % counter)
+                if random() < WHITEWASH_PROBABILITY:
+                    replica.whitewash()
+            if use_members:
+                replica.compact(other for other in peers if other != peer)
+        buffers = {peer: Codec.dumps(replica) for peer, replica in replicas.items()}
+        for peer, buffer in buffers.items():
+            for other, replica in replicas.items():
+                if other != peer:
+                    state = Codec.loads(buffer)
+                    replica.combine(state)
+                    replica.acknowledge(peer, state)
+        if round % 5 == 4:
+            print("%s;%s;%s;%s;%s;%s" % (kind.__name__, use_members, round + 1,
+                                         sum(garbage(replica) for replica in replicas.values()) / REPLICAS,
+                                         sum(len(buffer) for buffer in buffers.values()) / REPLICAS,
+                                         len(set(len(replica) for replica in replicas.values())) == 1))
+
+print("Type; Members; Round; Garbage; State size; Same size")
+for kind in [NaiveORSet, OptORSet]:
+    for use_members in [False, True]:
+        run(kind, use_members)
@@ -10,6 +10,7 @@ import timeit
 
 one = CrdtSet()
 old = NaiveORSet()
+opt = OptORSet()
 alt = OptORSet()
 
 alt2 = OptORSet()
@@ -21,7 +22,7 @@ alt.combine(alt2)
 
 
 #TODO: make a slightly better example that removes and adds stuff in a more realistic way, this way is worst case for the bloom filter
-print("Run; Min new; Max new; Min old; Max old")
+print("Run; Min new; Max new; Add new; Remove new; Min old; Max old; Add old; Remove old; Min opt; Max opt; Add opt; Remove opt")
 all_items = list(range(0, 1000))
 
 def adds(target):
@@ -49,4 +50,12 @@ for run in range(0, 30):
     time_old_rem = timeit.timeit(lambda: removes(old), number=1)
     max_old = max(max_old, len(pickle.dumps(old)))
 
-    print(";%s;%s;%s;%s" % (min_old, max_old, time_old_add, time_old_rem))
\ No newline at end of file
+    print(";%s;%s;%s;%s" % (min_old, max_old, time_old_add, time_old_rem), end = "")
+
+    min_opt = len(pickle.dumps(opt))
+    time_opt_add = timeit.timeit(lambda: adds(opt), number=1)
+    max_opt = len(pickle.dumps(opt))
+    time_opt_rem = timeit.timeit(lambda: removes(opt), number=1)
+    max_opt = max(max_opt, len(pickle.dumps(opt)))
+
+    print(";%s;%s;%s;%s" % (min_opt, max_opt, time_opt_add, time_opt_rem))
\ No newline at end of file
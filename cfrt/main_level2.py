@@ -1,56 +1,112 @@
-from CrdtRTree import current_root, CrdtRTree, touched_nodes, get
-from NaiveORSet import NaiveORSet
+#!/usr/bin/python3
+
+# the codec only knows the package classes, so import through the package rather than from this directory
+import experiments.cfrt.thesis.CrdtRTree as CrdtRTree
+import experiments.cfrt.thesis.Codec as Codec
+from experiments.cfrt.thesis.MaintenanceScheduler import MaintenanceScheduler
+from bisect import bisect_right
 from hashlib import md5
-from random import  shuffle
-import pickle
-
-# Generate root node
-CrdtRTree()
-naive = NaiveORSet()
-
-testdata = { }
-
-#generate test data
-finger = ""
-while len(testdata) < 5000:
-    next_finger = md5(finger.encode()).hexdigest()
-    testdata[finger] = next_finger
-    finger = next_finger
-
-i = 0
-for k, v in testdata.items():
-    current_root().add_leaf_item(k, v)
-    naive.add((k, v))
-    i += 1
-    if i % 100 == 0:
-        print("I: " + str(i))
-
-# To see what the tree looks like
-#current_root().debug_print()
-#print()
-
-distribution = {}
-size_distribution = {}
-
-for k, v in testdata.items():
-    touched_nodes.clear()
-    result = current_root().query_leaf_item(k)
-    index = len(touched_nodes)
-    if not index in distribution:
-        distribution[index] = 0
-        size_distribution[index] = 0
-    distribution[index] += 1
-    size_distribution[index] += sum(len(pickle.dumps(get(item))) for item in touched_nodes)
-    if result != v:
-        print("Query for '%s' result '%s' == '%s': '%s'" % (k, result, v, result == v))
-
-print("nodes_touched;occurrence_count;avg_bytes_touched")
-for k in sorted(distribution.keys()):
-    print(str(k) + ";" + str(distribution[k]) + ";" + str(size_distribution[k]/distribution[k]))
-
-print()
-print("Naive OR-set size: " + str(len(pickle.dumps(naive))))
-kv = list(testdata.items())
-shuffle(kv)
-for k, _ in kv:
-    current_root().del_leaf_item(k)
+from random import seed
+import sys
+import timeit
+
+# Builds a tree per split policy, and one bulk loaded tree, from the same data and reports its quality: the number of
+# nodes, the depth, the number of overlapping sibling pairs and the nodes and bytes a point query touches on average.
+# The data is read from the file given as argument, one "key;value" line per item like the datasources, or generated.
+
+# keeps the nodes in memory and records which of them a query fetched
+class BenchmarkContext(CrdtRTree.CrdtRTreeContext):
+    def __init__(self, policy: str = None) -> None:
+        super().__init__(policy)
+        self.touched = set()
+        self.scheduler = MaintenanceScheduler()
+
+    def get(self, node_id):
+        self.touched.add(node_id)
+        return super().get(node_id)
+
+    def schedule(self, node, height):
+        self.scheduler.schedule(node, height)
+
+def load_testdata():
+    testdata = {}
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as source:
+            for line in source:
+                line = line.rstrip("\n")
+                testdata[line.split(';', maxsplit=1)[0]] = line
+        return testdata
+    finger = ""
+    while len(testdata) < 5000:
+        next_finger = md5(finger.encode()).hexdigest()
+        testdata[finger] = next_finger
+        finger = next_finger
+    return testdata
+
+def build(testdata, policy):
+    context = BenchmarkContext(policy)
+    context.init_root()
+    i = 0
+    for k, v in testdata.items():
+        context.root.add_leaf_item(k, v)
+        i += 1
+        if i % 20 == 0:
+            context.scheduler.run_all()
+    context.scheduler.run_all()
+    return context
+
+def bulk_build(testdata):
+    context = BenchmarkContext()
+    context.bulk_load(testdata.items())
+    return context
+
+# number of pairs of entries in the node whose ranges overlap
+def overlaps(node):
+    entries = [item for item in node if not item.is_leaf]
+    mins = [item.key_min for item in entries]
+    return sum(bisect_right(mins, item.key_max) - i - 1 for i, item in enumerate(entries))
+
+# returns the node count, depth and overlap count of the tree below node
+def shape(context, node):
+    count = 1
+    depth = 1
+    overlap = overlaps(node)
+    for child in node.compute_children():
+        sub = context.nodes.get(child)
+        if sub is None:
+            continue
+        sub_count, sub_depth, sub_overlap = shape(context, sub)
+        count += sub_count
+        depth = max(depth, sub_depth + 1)
+        overlap += sub_overlap
+    return count, depth, overlap
+
+def measure(testdata, name, build):
+    start_time = timeit.default_timer()
+    context = build()
+    build_time = timeit.default_timer() - start_time
+    tree = context.root
+    count, depth, overlap = shape(context, tree)
+    sizes = {}
+    total_touched = 0
+    total_bytes = 0
+    for k, v in testdata.items():
+        context.touched.clear()
+        context.touched.add(tree.content_id)
+        result = tree.query_leaf_item(k)
+        if result != v:
+            print("Query for '%s' result '%s' == '%s': '%s'" % (k, result, v, result == v))
+        for node_id in context.touched:
+            if not node_id in sizes:
+                sizes[node_id] = len(Codec.dumps(context.nodes[node_id].state))
+            total_bytes += sizes[node_id]
+        total_touched += len(context.touched)
+    print("%s;%s;%s;%s;%s;%s;%s" % (name, count, depth, overlap, build_time, total_touched / len(testdata), total_bytes / len(testdata)))
+
+testdata = load_testdata()
+print("Policy; Nodes; Depth; Overlaps; Build time; Avg nodes touched; Avg bytes touched")
+for policy in CrdtRTree.SPLIT_POLICIES.keys():
+    seed(0)
+    measure(testdata, policy, lambda: build(testdata, policy))
+seed(0)
+measure(testdata, "bulk", lambda: bulk_build(testdata))
@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+
+# the codec only knows the package classes, so import through the package rather than from this directory
+from experiments.cfrt.thesis.CrdtSet import CrdtSet
+import experiments.cfrt.thesis.Codec as Codec
+import tracemalloc
+
+# Measures the memory a CrdtSet takes per entry, on top of the element strings which are allocated up front and
+# belong to the application. Removes a tenth of the elements again, so the tombstones are part of the footprint.
+SIZES = [10000, 100000, 1000000]
+
+print("Elements; Live entries; Bytes per entry; Encoded bytes per entry")
+for size in SIZES:
+    items = [str(x) for x in range(0, size)]
+    tracemalloc.start()
+    replica = CrdtSet()
+    for item in items:
+        replica.add(item)
+    for item in items[::10]:
+        replica.remove(item)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    encoded = len(Codec.dumps(replica))
+    print("%s;%s;%s;%s" % (size, len(replica), used / size, encoded / size))
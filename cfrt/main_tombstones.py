@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+# the codec only knows the package classes, so import through the package rather than from this directory
+from experiments.cfrt.thesis.CrdtSet import CrdtSet
+from experiments.cfrt.thesis.TombstoneStore import TOMBSTONE_STORES, AUTO
+import experiments.cfrt.thesis.Codec as Codec
+from random import shuffle
+import timeit
+
+# Compares state size and combine latency of the tombstone stores for differently sized nodes, as sent by the codec.
+# Every node gets `size` elements of which half are removed on one replica, the other replica re-adds a quarter.
+SIZES = [16, 48, 512, 2000]
+RUNS = 10
+
+def build(kind, size):
+    items = [str(x) for x in range(0, size)]
+    shuffle(items)
+    left = CrdtSet(tombstones=kind)
+    right = CrdtSet(tombstones=kind)
+    for item in items:
+        left.add(item)
+    right.combine(left)
+    for item in items[:size >> 1]:
+        left.remove(item)
+    for item in items[size >> 1:(size >> 1) + (size >> 2)]:
+        right.remove(item)
+        right.add(item)
+    return left, right
+
+print("Store; Elements; Tombstones; State size; Combine time")
+for size in SIZES:
+    for kind in [AUTO] + list(TOMBSTONE_STORES.keys()):
+        left, right = build(kind, size)
+        buffer = Codec.dumps(left)
+        time_combine = min(timeit.repeat(lambda: Codec.loads(buffer).combine(right), repeat=RUNS, number=1))
+        time_decode = min(timeit.repeat(lambda: Codec.loads(buffer), repeat=RUNS, number=1))
+        print("%s;%s;%s;%s;%s" % (kind, size, len(left.tombstones), len(buffer), time_combine - time_decode))
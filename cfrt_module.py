@@ -4,7 +4,6 @@ from subprocess import run
 
 from typing import Union
 
-import pickle
 import shlex
 
 from random import choice
@@ -19,58 +18,107 @@ from ipv8.configuration import Strategy, WalkerDefinition, default_bootstrap_def
 from experiments.cfrt.thesis.CrdtCommunity import CrdtCommunity
 from experiments.cfrt.thesis.CrdtSet import CrdtSet
 import experiments.cfrt.thesis.CrdtRTree as CrdtRTree
+import experiments.cfrt.thesis.Codec as Codec
+from experiments.cfrt.thesis.MaintenanceScheduler import MaintenanceScheduler
+from experiments.cfrt.thesis.TombstoneStore import set_default_tombstones
+
+# A tree whose nodes are the inner replicas of the community, with its root pointer as a ("root", node id) entry in the
+# root replica. Other trees in the same community use a "root:<name>" entry instead, their nodes live next to each
+# other in the inner replicas and share the community and the maintenance scheduler.
+class CommunityTreeContext(CrdtRTree.CrdtRTreeContext):
+    def __init__(self, module: "CfrtModule", name: str = "") -> None:
+        super().__init__()
+        self.module = module
+        self.root_key = "root" if len(name) == 0 else "root:" + name
 
-node_cache = {}
-
-def ResolveRTreeNode(community: "CrdtCommunity", fetch_id: str) -> Union[None, "CrdtRTree.CrdtRTree"]:
-    result = None
-    if fetch_id in node_cache:
-        result = node_cache[fetch_id]
-    elif fetch_id in community.inner_replicas:
-        result = CrdtRTree.CrdtRTree()
-        result.content_id = fetch_id
-        result.state = community.inner_replicas[fetch_id]
-        node_cache[fetch_id] = result
-    if not result is None:
-        result.touched = True
-    return result
-
-async def ResolveRTreeNodeAsync(community: "CrdtCommunity", fetch_id: str) -> Union[None, "CrdtRTree.CrdtRTree"]:
-    result = ResolveRTreeNode(community, fetch_id)
-    if result is None:
-        # ask the community about it
-        result = await community.get(fetch_id)
-        print("Resolving %s, community result %r" % (fetch_id, result))
-        if result is None:
-            print("Unable to find node for id %r" % fetch_id, file=sys.stderr)
-            return None
-        community.inner_replicas[fetch_id] = result
-        node = CrdtRTree.CrdtRTree()
+    @property
+    def community(self) -> "CrdtCommunity":
+        return self.module.community
+
+    # the community holds the replicas of every tree, one that is already bound to another tree is not resolved here
+    def get(self, fetch_id: str) -> Union[None, "CrdtRTree.CrdtRTree"]:
+        result = None
+        if fetch_id in self.nodes:
+            result = self.nodes[fetch_id]
+        elif fetch_id in self.community.inner_replicas and self.module.tree_of(fetch_id) is None:
+            result = self.wrap(fetch_id, self.community.inner_replicas[fetch_id])
+        if not result is None:
+            result.touched = True
+        return result
+
+    async def get_async(self, fetch_id: str) -> Union[None, "CrdtRTree.CrdtRTree"]:
+        result = self.get(fetch_id)
+        if result is None and self.module.tree_of(fetch_id) is None:
+            # ask the community about it
+            result = await self.community.get(fetch_id)
+            print("Resolving %s, community result %r" % (fetch_id, result))
+            if result is None:
+                print("Unable to find node for id %r" % fetch_id, file=sys.stderr)
+                return None
+            self.community.inner_replicas[fetch_id] = result
+            return self.wrap(fetch_id, result)
+        return result
+
+    def wrap(self, fetch_id: str, state: "CrdtSet") -> "CrdtRTree.CrdtRTree":
+        node = CrdtRTree.CrdtRTree(self)
         node.content_id = fetch_id
-        node.state = result
-        node_cache[fetch_id] = node
+        node.state = state
+        self.nodes[fetch_id] = node
         return node
-    return result
-
-def AddRTreeNode(community: "CrdtCommunity", node: "CrdtRTree.CrdtRTree"):
-    print("Added node for id %r" % node.content_id, file=sys.stderr)
-    community.inner_replicas[node.content_id] = node.state
-
-def UpdateRoot(root_replica: "CrdtSet", node: str):
-    for item in list(root_replica):
-        if item[0] == "root":
-            root_replica.remove(item)
-    root_replica.add(("root", node))
-
-def CountTouchedNodes():
-    count = 0
-    size = 0
-    for node in node_cache.values():
-        if node.touched:
-            node.touched = False
-            count += 1
-            size += len(pickle.dumps(node.state))
-    return count, size
+
+    def add_node(self, node: "CrdtRTree.CrdtRTree"):
+        print("Added node for id %r" % node.content_id, file=sys.stderr)
+        self.community.inner_replicas[node.content_id] = node.state
+
+    def set_root(self, node: str):
+        root_replica = self.module.root_replica
+        for item in list(root_replica):
+            if item[0] == self.root_key:
+                root_replica.remove(item)
+        root_replica.add((self.root_key, node))
+
+    def schedule(self, node: "CrdtRTree.CrdtRTree", height: int):
+        self.module.scheduler.schedule(node, height)
+
+    def remove_node(self, node_id: str):
+        super().remove_node(node_id)
+        self.community.remove_replica(node_id)
+
+    @property
+    def root(self) -> Union[None, "CrdtRTree.CrdtRTree"]:
+        roots = [self.get(item[1]) for item in self.module.root_replica if item[0] == self.root_key]
+        if len(roots) == 0:
+            return None
+        return choice(roots)
+
+    def init_root(self) -> "CrdtRTree.CrdtRTree":
+        new_root = CrdtRTree.CrdtRTree(self)
+        self.community.inner_replicas[new_root.content_id] = new_root.state
+        self.set_root(new_root.content_id)
+        return new_root
+
+    # resolves every node reachable from the roots of this tree
+    def resolve_nodes(self) -> None:
+        pending = [item[1] for item in self.module.root_replica if item[0] == self.root_key]
+        seen = set(pending)
+        while len(pending) > 0:
+            node = self.get(pending.pop())
+            if node is None:
+                continue
+            for child in node.compute_children():
+                if not child in seen:
+                    seen.add(child)
+                    pending.append(child)
+
+    def count_touched_nodes(self):
+        count = 0
+        size = 0
+        for node in self.nodes.values():
+            if node.touched:
+                node.touched = False
+                count += 1
+                size += len(Codec.dumps(node.state))
+        return count, size
 
 alphabeth = "abcdefghijklmnopqrstuvwxyz0123456789"
 
@@ -86,7 +134,7 @@ class CfrtModule(PureIPv8Module):
     def __init__(self, experiment):
         super(CfrtModule, self).__init__(experiment)
         self.community = None
-        self.tasks = {"stats": None, "add": None, "remove": None, "merge": None}
+        self.tasks = {"stats": None, "add": None, "remove": None, "merge": None, "maintenance": None}
         self.my_entries = {}
         self.add_count = 0
         self.remove_count = 0
@@ -100,14 +148,26 @@ class CfrtModule(PureIPv8Module):
         self.root_size = "finite"
         self.last_data = None
         self.data_source = None
+        self.scheduler = MaintenanceScheduler()
+        # tree name -> context, the unnamed tree is the one the experiment callbacks work on
+        self.trees = {"": CommunityTreeContext(self)}
 
-        CrdtRTree.get = lambda x: ResolveRTreeNode(self.community, x)
-        CrdtRTree.add_node = lambda x: AddRTreeNode(self.community, x)
-        CrdtRTree.set_root = lambda x: UpdateRoot(self.root_replica, x)
-        CrdtRTree.get_async = self.get_node
-
-    async def get_node(self, fetch_id):
-        return await ResolveRTreeNodeAsync(self.community, fetch_id)
+    @property
+    def tree(self) -> CommunityTreeContext:
+        return self.trees[""]
+
+    # the tree whose context has a node bound to the replica, if any
+    def tree_of(self, fetch_id: str) -> Union[None, CommunityTreeContext]:
+        for tree in self.trees.values():
+            if fetch_id in tree.nodes:
+                return tree
+        return None
+
+    # returns the context of the named tree, creating it when it doesn't exist yet
+    def get_tree(self, name: str) -> CommunityTreeContext:
+        if not name in self.trees:
+            self.trees[name] = CommunityTreeContext(self, name)
+        return self.trees[name]
 
     def on_id_received(self):
         super(CfrtModule, self).on_id_received()
@@ -128,6 +188,15 @@ class CfrtModule(PureIPv8Module):
             if int(peer_id) != self.my_id:
                 self.community.walk_to(self.experiment.get_peer_ip_port_by_id(peer_id))
 
+    # Takes the peers known now as the replicas of the tree, which lets replica state be garbage collected. Meant to
+    # run once every peer has been introduced.
+    @experiment_callback
+    def cfrt_set_members(self):
+        peers = self.community.get_peers()
+        if len(peers) < len(self.all_vars) - 1:
+            print("Setting %s members, expected %s" % (len(peers), len(self.all_vars) - 1), file=sys.stderr)
+        self.community.set_members(peer.mid for peer in peers)
+
     @experiment_callback
     def set_datasource(self, source):
         start_time = perf_counter()
@@ -143,18 +212,25 @@ class CfrtModule(PureIPv8Module):
         count = 0
         print("Starting adding datasource items")
         sys.stdout.flush()
+        # An empty tree is built bottom up in one go, rather than by splitting its way up from a single leaf. A root of
+        # infinite size has to stay the root, so that one is still filled item by item.
+        if len(self.tree_root) == 0 and self.root_size != "infinite":
+            start_time = perf_counter()
+            self.tree.bulk_load((line.split(';', maxsplit=1)[0], line) for line in self.data_source)
+            self.tree.count_touched_nodes()
+            print("Done bulk loading items %s @ %s in %s seconds" % (len(self.data_source), self.experiment_time, perf_counter() - start_time))
+            sys.stdout.flush()
+            return
         for line in self.data_source:
             last_data = line.split(';', maxsplit=1)
             self.tree_root.add_leaf_item(last_data[0], line)
             count += 1
             if count % 20 == 0:
-                for node in list(node_cache.values()):
-                    if node.should_check:
-                        node.do_check()
+                self.scheduler.run_all()
             if count % 1000 == 0:
-                print ("Done add %s, nodes %s" % (count, len(node_cache)))
+                print ("Done add %s, nodes %s" % (count, len(self.tree.nodes)))
                 sys.stdout.flush()
-        CountTouchedNodes()
+        self.tree.count_touched_nodes()
         print("Done adding items %s @ %s" % (len(self.data_source), self.experiment_time))
         sys.stdout.flush()
 
@@ -184,16 +260,53 @@ class CfrtModule(PureIPv8Module):
                 sys.stdout.flush()
                 sys.stderr.flush()
 
+    # Like verify_datasource_items, but looks all keys up in one query_many_async. Nodes are fetched once per level
+    # rather than once per key, so only the time for the whole batch is known.
+    @experiment_callback
+    async def verify_datasource_items_batched(self):
+        self.community.network.print_debug()
+
+        await self.community.get(None)
+        for item in self.root_replica:
+            if item[0] == "root":
+                await  self.community.get(item[1])
+
+        try:
+            lines = {line.split(';', maxsplit=1)[0]: line for line in self.data_source}
+            query_start_time = perf_counter()
+            results = await self.tree_root.query_many_async(lines.keys())
+            for key, line in lines.items():
+                if line != results[key]:
+                    print("Difference on %s, expected '%s' got '%s'" % (key, line, results[key]))
+            print("%s;%s;validate_batch" % (perf_counter() - query_start_time, len(lines)))
+            sys.stdout.flush()
+        except:
+            traceback.print_exc()
+            sys.stdout.flush()
+            sys.stderr.flush()
+
     @experiment_callback
     async def start_ipv8(self):
         await super(CfrtModule, self).start_ipv8()
         self.community = self.ipv8.overlays[0]
 
     @experiment_callback
-    def init_root(self):
-        new_root = CrdtRTree.CrdtRTree()
-        self.community.inner_replicas[new_root.content_id] = new_root.state
-        CrdtRTree.set_root(new_root.content_id)
+    def init_root(self, tree=""):
+        self.get_tree(tree).init_root()
+
+    # configures the split policy and the split and join threshold ranges of the nodes created from now on
+    @experiment_callback
+    def cfrt_set_split_policy(self, policy, split_min=24, split_max=48, join_min=8, join_max=12, split_ways=3, tree=""):
+        self.get_tree(tree).configure(policy, (int(split_min), int(split_max)), (int(join_min), int(join_max)), int(split_ways))
+
+    @experiment_callback
+    def cfrt_set_deltas(self, enabled):
+        self.community.use_deltas = enabled in (True, "1", "true", "True")
+
+    # the tombstone store kind is shared by the whole community, so every peer has to run this with the same arguments
+    @experiment_callback
+    def cfrt_set_tombstones(self, kind, promote_to=None):
+        set_default_tombstones(kind, promote_to)
 
     @experiment_callback
     def cfrt_root_size_infinite(self):
@@ -208,7 +321,7 @@ class CfrtModule(PureIPv8Module):
 
     @property
     def tree_root(self) -> "CrdtRTree.CrdtRTree":
-        return choice([CrdtRTree.get(item[1]) for item in self.root_replica if item[0] == "root"])
+        return self.tree.root
 
     @experiment_callback
     def cfrt_start_stats_task(self, interval=0.325):
@@ -258,9 +371,41 @@ class CfrtModule(PureIPv8Module):
             self.tasks["merge"].cancel()
             self.tasks["merge"] = None
 
+    # runs a slice of the pending node checks every interval, between the merge rounds
+    @experiment_callback
+    def cfrt_start_maintenance_task(self, interval=0.05, slice_time=None):
+        interval=float(interval)
+        if not slice_time is None:
+            self.scheduler.slice_time = float(slice_time)
+        self.tasks["maintenance"] = run_task(self.cfrt_maintenance, delay=self.my_id * interval / len(self.experiment.all_vars), interval=interval)
+
+    @experiment_callback
+    def cfrt_stop_maintenance_task(self):
+        if "maintenance" in self.tasks and not self.tasks["maintenance"] is None:
+            self.tasks["maintenance"].cancel()
+            self.tasks["maintenance"] = None
+
+    # runs a slice of the pending node checks, or all of them when drain is set
+    def cfrt_maintenance(self, drain=False):
+        try:
+            check_size = 0
+            def observe(node):
+                nonlocal check_size
+                check_size += len(Codec.dumps(node.state))
+            if drain:
+                checked = self.scheduler.run_all(observe=observe)
+            else:
+                checked = self.scheduler.run_slice(observe=observe)
+            if len(checked) > 0:
+                self.check_events.append((len(checked), check_size))
+        except:
+            traceback.print_exc()
+            sys.stdout.flush()
+            sys.stderr.flush()
+
     @experiment_callback
     def cfrt_add(self, count=1, total=None):
-        CountTouchedNodes()     # zero touched state
+        self.tree.count_touched_nodes()     # zero touched state
         try:
             if not total is None:
                 # need to take care of fractions to ensure the total is accurate
@@ -276,7 +421,7 @@ class CfrtModule(PureIPv8Module):
                 #print("added k:%s v:%s" % (key, value))
                 self.add_count += 1
                 count -= 1
-                self.touched_events.append(CountTouchedNodes())
+                self.touched_events.append(self.tree.count_touched_nodes())
         except:
             traceback.print_exc()
             sys.stdout.flush()
@@ -284,12 +429,12 @@ class CfrtModule(PureIPv8Module):
 
     @experiment_callback
     def cfrt_add_item(self, key, value):
-        CountTouchedNodes()     # zero touched state
+        self.tree.count_touched_nodes()     # zero touched state
         try:
             self.tree_root.add_leaf_item(key, value)
             self.my_entries[key] = value
             self.add_count += 1
-            self.touched_events.append(CountTouchedNodes())
+            self.touched_events.append(self.tree.count_touched_nodes())
         except:
             traceback.print_exc()
             sys.stdout.flush()
@@ -297,7 +442,7 @@ class CfrtModule(PureIPv8Module):
 
     @experiment_callback
     def cfrt_remove(self, count=1):
-        CountTouchedNodes()     # zero touched state
+        self.tree.count_touched_nodes()     # zero touched state
         try:
             count = min(int(count), len(self.my_entries))
             while count > 0:
@@ -307,7 +452,7 @@ class CfrtModule(PureIPv8Module):
                 #print("rem selected %s" % rem_element)
                 self.remove_count += 1
                 count -= 1
-                self.touched_events.append(CountTouchedNodes())
+                self.touched_events.append(self.tree.count_touched_nodes())
         except:
             traceback.print_exc()
             sys.stdout.flush()
@@ -316,15 +461,8 @@ class CfrtModule(PureIPv8Module):
     @experiment_callback
     def cfrt_merge(self):
         try:
-            check_count = 0
-            check_size = 0
-            for node in list(node_cache.values()):
-                if node.should_check:
-                    check_count += 1
-                    check_size += len(pickle.dumps(node.state))
-                    node.do_check()
-            if check_count > 0:
-                self.check_events.append((check_count, check_size))
+            # without the maintenance task, every merge checks all pending nodes like it always did
+            self.cfrt_maintenance(drain=self.tasks["maintenance"] is None)
             if (not self.only_dirty) or self.root_replica.Dirty:
                 self.root_replica.Dirty = True
                 self.community.broadcast_state()
@@ -349,8 +487,8 @@ class CfrtModule(PureIPv8Module):
             self.last_touch_size = size/len(self.touched_events)
             self.touched_events = []
 
-        for replica in self.community.inner_replicas.keys():
-            CrdtRTree.get(replica)
+        for tree in self.trees.values():
+            tree.resolve_nodes()
         self.touched_events = []
 
         if len(self.check_events) > 0:
@@ -380,13 +518,13 @@ class CfrtModule(PureIPv8Module):
                 len(all_entries),
                 self.add_count,
                 self.remove_count,
-                len([item for item in node_cache.values() if len(item) > 0]),
+                sum(len([item for item in tree.nodes.values() if len(item) > 0]) for tree in self.trees.values()),
                 self.last_touch_count,
                 self.last_touch_size,
                 self.last_check_count,
                 self.last_check_size,
-                CrdtRTree.split_count,
-                CrdtRTree.merge_count,
+                sum(tree.split_count for tree in self.trees.values()),
+                sum(tree.merge_count for tree in self.trees.values()),
                 self.community.stats["merge_count"],
                 self.community.stats["pass_count"],
                 self.community.stats["drop_count"],
@@ -399,7 +537,7 @@ class CfrtModule(PureIPv8Module):
             #self.community.stats["drop_count"] = 0
 
             #print("Root replica: %s" % self.root_replica)
-            #for root in (CrdtRTree.get(item[1]) for item in self.root_replica if item[0] == "root"):
+            #for root in (self.tree.get(item[1]) for item in self.root_replica if item[0] == "root"):
             #    root.debug_print(0)
             sys.stdout.flush()
         except:
@@ -1,6 +1,5 @@
-import pickle
 import sys
-from random import randint, choice
+from random import randint, sample
 
 from gumby.experiment import experiment_callback
 from gumby.util import run_task
@@ -12,6 +11,8 @@ from experiments.cfrt.thesis.CrdtCommunity import CrdtCommunity
 from experiments.cfrt.thesis.CrdtSet import CrdtSet
 from experiments.cfrt.thesis.NaiveORSet import NaiveORSet
 from experiments.cfrt.thesis.OptOrSet import OptORSet
+from experiments.cfrt.thesis.TombstoneStore import set_default_tombstones
+import experiments.cfrt.thesis.Codec as Codec
 
 
 @static_module
@@ -106,6 +107,28 @@ class CrdtModule(PureIPv8Module):
             self.replica = NaiveORSet()
         self.community.replica = self.replica
 
+    # the tombstone store kind is shared by the whole community, so every peer has to run this with the same arguments
+    @experiment_callback
+    def crdt_set_tombstones(self, kind, promote_to=None):
+        set_default_tombstones(kind, promote_to)
+
+    @experiment_callback
+    def crdt_set_deltas(self, enabled):
+        self.community.use_deltas = enabled in (True, "1", "true", "True")
+
+    @experiment_callback
+    def crdt_set_reconciliation(self, enabled):
+        self.community.use_reconciliation = enabled in (True, "1", "true", "True")
+
+    # Takes the peers known now as the replicas of the set, which lets tombstones and retired ids be garbage collected.
+    # Meant to run once every peer has been introduced.
+    @experiment_callback
+    def crdt_set_members(self):
+        peers = self.community.get_peers()
+        if len(peers) < len(self.all_vars) - 1:
+            print("Setting %s members, expected %s" % (len(peers), len(self.all_vars) - 1), file=sys.stderr)
+        self.community.set_members(peer.mid for peer in peers)
+
     @experiment_callback
     def crdt_add(self, element=None, count=1, total=None):
         if not total is None:
@@ -114,13 +137,11 @@ class CrdtModule(PureIPv8Module):
             count = int((self.my_id + 1) * per_node) - int(self.my_id * per_node)
         else:
             count = int(count)
-        while count > 0:
-            add_element = element
-            if add_element is None:
-                add_element = "%s;%s" % (self.my_id, randint(0, 2 ** 31 - 1))
-            #print("added %s" % add_element)
-            self.replica.add(add_element)
-            count -= 1
+        if element is None:
+            elements = ["%s;%s" % (self.my_id, randint(0, 2 ** 31 - 1)) for _ in range(0, count)]
+        else:
+            elements = [element] * count
+        self.replica.add_many(elements)
 
     @experiment_callback
     def crdt_remove(self, element=None, count=1, own=False):
@@ -128,15 +149,11 @@ class CrdtModule(PureIPv8Module):
         my_elements = list(item for item in self.replica if item.startswith(my_prefix))
         #print("rem called. element %s, count %s, my_prefix %s, len(my_elements) %s" % (element, count, my_prefix, len(my_elements)))
         count = min(int(count), len(my_elements))
-        while count > 0:
-            rem_element = element
-            if rem_element is None:
-                rem_element = choice(my_elements)
-                my_elements.remove(rem_element)
-
-            #print("rem selected %s" % rem_element)
-            self.replica.remove(rem_element)
-            count -= 1
+        if element is None:
+            elements = sample(my_elements, count)
+        else:
+            elements = [element] * count
+        self.replica.remove_many(elements)
 
     @experiment_callback
     def crdt_whitewash(self):
@@ -150,7 +167,7 @@ class CrdtModule(PureIPv8Module):
             int(self.experiment_time),
             type(self.replica).__name__,
             len(self.replica),
-            len(pickle.dumps(self.replica)),
+            len(Codec.dumps(self.replica)),
             self.community.stats["merge_count"],
             self.community.stats["last_merge_time"],
             self.community.stats["last_unpickle_time"],